@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Checks that importing rainy stays within its start-up budget.
+
+Every run of rainy, even one served entirely from the cache, pays for importing the script. Heavy modules like requests
+must only be imported by the code paths that need them. This check imports rainy in fresh interpreters, takes the fastest
+of several runs as measured by 'python -X importtime' and fails if it exceeds the budget or if any heavy module was imported.
+
+Usage: python bench/check_import_time.py [--budget-ms 15] [--runs 10]
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+
+# modules that must not be loaded just by importing rainy
+HEAVY_MODULES = ("requests", "urllib3", "emoji", "termcolor", "configparser", "argparse", "concurrent.futures")
+
+PROBE = "import sys, rainy; print(','.join(m for m in {modules!r} if m in sys.modules))"
+
+
+def measure_import_time() -> tuple[float, list[str]]:
+    """
+    Imports rainy in a fresh interpreter.
+
+    :return: tuple: The cumulative import time of rainy in milliseconds on index 0 and the heavy modules that were imported on index 1.
+    """
+    # like for every import, the bytecode should come from __pycache__ instead of compiling the script each time
+    env = {key: value for key, value in os.environ.items() if key != "PYTHONDONTWRITEBYTECODE"}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE.format(modules=HEAVY_MODULES)],
+        cwd=SRC_DIR, env=env, capture_output=True, text=True, check=True
+    )
+    for line in result.stderr.splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == "rainy":
+            imported = [module for module in result.stdout.strip().split(",") if module]
+            return int(fields[1]) / 1000, imported
+    raise RuntimeError("rainy doesn't show up in the output of -X importtime.")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check that importing rainy stays within its start-up budget.")
+    parser.add_argument("--budget-ms", type=float, default=15.0, help="The maximum import time in milliseconds. Default: 15")
+    parser.add_argument("--runs", type=int, default=10, help="How often to import rainy. The fastest run counts. Default: 10")
+    args = parser.parse_args()
+
+    timings = []
+    for _ in range(args.runs):
+        import_time, imported = measure_import_time()
+        if imported:
+            print(f"FAIL: importing rainy imports {', '.join(imported)}")
+            exit(1)
+        timings.append(import_time)
+
+    best = min(timings)
+    if best > args.budget_ms:
+        print(f"FAIL: importing rainy takes {best:.2f} ms, the budget is {args.budget_ms:.2f} ms")
+        exit(1)
+    print(f"OK: importing rainy takes {best:.2f} ms, the budget is {args.budget_ms:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
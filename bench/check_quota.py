@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Checks that the host-wide rate limiter of rainy hands out tokens on time.
+
+A bucket holding less than one token must hand out the next one within the time it takes to accrue the rest of it,
+(1 - tokens) / rate. The check drains the bucket of a temporary cache directory to the passed number of tokens,
+waits a bit like a process arriving later would, and times acquire_quota in a fresh interpreter.
+
+Usage: python bench/check_quota.py [--per-minute 60] [--tokens 0.2] [--delay 0.5]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+
+PROBE = """
+import time, rainy
+rainy.network_settings["open_meteo_per_minute"] = {per_minute}
+start = time.perf_counter()
+rainy.acquire_quota("forecast")
+print(time.perf_counter() - start)
+"""
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check that the rate limiter of rainy hands out tokens on time.")
+    parser.add_argument("--per-minute", type=int, default=60, help="The limit per minute. Default: 60")
+    parser.add_argument("--tokens", type=float, default=0.2, help="The tokens left in the bucket, below 1. Default: 0.2")
+    parser.add_argument("--delay", type=float, default=0.5, help="The time in seconds between draining the bucket and asking for a token. Default: 0.5")
+    args = parser.parse_args()
+
+    rate = args.per_minute / 60
+    budget = max(0.0, (1 - args.tokens) / rate - args.delay)
+    with tempfile.TemporaryDirectory(prefix="rainy-check-") as directory:
+        cache_dir = os.path.join(directory, "rainy")
+        os.makedirs(cache_dir)
+        with open(os.path.join(cache_dir, "quota.json"), "w", encoding="utf-8") as file:
+            day = time.strftime("%Y-%m-%d", time.gmtime())
+            json.dump({"day": day, "month": day[:7], "apis": {"open-meteo": {"day": 0, "month": 0, "tokens": args.tokens, "updated": time.time()}}}, file)
+        time.sleep(args.delay)
+
+        env = {**os.environ, "XDG_CACHE_HOME": directory}
+        try:
+            result = subprocess.run([sys.executable, "-c", PROBE.format(per_minute=args.per_minute)], cwd=SRC_DIR, env=env, capture_output=True, text=True, check=True, timeout=budget + 5)
+        except subprocess.TimeoutExpired:
+            print(f"FAIL: acquire_quota didn't return within {budget + 5:.2f} s")
+            exit(1)
+
+    waited = float(result.stdout)
+    # the interpreter and the quota file take a moment as well
+    if waited > budget + 0.1:
+        print(f"FAIL: acquire_quota waited {waited:.3f} s for a token, it should be available after {budget:.3f} s")
+        exit(1)
+    print(f"OK: acquire_quota waited {waited:.3f} s for a token, it is available after {budget:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
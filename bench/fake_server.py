@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for the APIs rainy uses, so rainy can be run and benchmarked without internet access.
+
+It answers the ipinfo.io (/json), Open-Meteo geocoding (/v1/search) and Open-Meteo forecast (/v1/forecast) endpoints
+with deterministic data in the same shape as the real APIs. Latency and failures can be injected.
+Like a real HTTP server, it compresses responses with gzip or deflate if the client accepts it, sends an ETag and Last-Modified
+and answers conditional requests with '304 Not Modified'. The current conditions change every 15 minutes, like on Open-Meteo.
+Point rainy at it with the RAINY_IPINFO_URI, RAINY_GEOCODING_URI and RAINY_FORECAST_URI environment variables,
+see FakeServer.environ().
+
+Usage: python bench/fake_server.py [--port 8080] [--latency-ms 0] [--failure-rate 0] [--no-compression] [--max-age 0]
+"""
+
+import gzip
+import json
+import time
+import random
+import zlib
+import hashlib
+import email.utils
+import argparse
+import threading
+import collections
+import urllib.parse
+import http.server
+
+
+def get_coordinates(name: str) -> tuple[float, float]:
+    """
+    Derives stable, made-up coordinates from the passed city name.
+
+    :param name: The name of the city.
+    :type name: str
+    :returns: tuple: The latitude on index 0 and the longitude on index 1.
+    """
+    checksum = zlib.crc32(name.casefold().encode("utf-8"))
+    return round(-60 + checksum % 12000 / 100, 4), round(-180 + (checksum // 12000) % 36000 / 100, 4)
+
+
+# how often the made-up current conditions change in seconds
+UPDATE_INTERVAL = 900
+
+
+def get_forecast(latitude: float, longitude: float, current: str | None = None, daily: str | None = None) -> dict:
+    """
+    Makes up a forecast for the passed location in the shape returned by api.open-meteo.com.
+
+    :param latitude: The latitude of the location.
+    :type latitude: float
+    :param longitude: The longitude of the location.
+    :type longitude: float
+    :param current: The comma-separated current variables to include, like the 'current' parameter of the API. None includes all of them.
+    :param daily: The comma-separated daily variables to include, like the 'daily' parameter of the API. None includes all of them.
+    :return: The forecast of a single location.
+    """
+    checksum = zlib.crc32(f"{latitude:.2f},{longitude:.2f}".encode("ascii"))
+    temperature = round(checksum % 400 / 10 - 10, 1)
+    updated = time.gmtime(time.time() // UPDATE_INTERVAL * UPDATE_INTERVAL)
+    forecast = {
+        "latitude": latitude,
+        "longitude": longitude,
+        "utc_offset_seconds": 0,
+        "timezone": "GMT",
+        "current": {
+            "time": time.strftime("%Y-%m-%dT%H:%M", updated),
+            "interval": 900,
+            "temperature_2m": temperature,
+            "apparent_temperature": round(temperature - 1.5, 1),
+            "weather_code": (0, 1, 2, 3, 45, 61, 71, 95)[checksum % 8],
+            "wind_speed_10m": round(checksum % 300 / 10, 1),
+            "wind_direction_10m": checksum % 360,
+            "is_day": 1,
+        },
+        "daily": {
+            "time": [time.strftime("%Y-%m-%d", time.gmtime())],
+            "sunrise": [time.strftime("%Y-%m-%dT06:%M", time.gmtime())],
+            "sunset": [time.strftime("%Y-%m-%dT18:%M", time.gmtime())],
+            "temperature_2m_max": [round(temperature + 4, 1)],
+            "temperature_2m_min": [round(temperature - 4, 1)],
+        },
+    }
+    for block, names in (("current", current), ("daily", daily)):
+        if names is not None:
+            wanted = {"time", "interval", *names.split(",")}
+            forecast[block] = {name: value for name, value in forecast[block].items() if name in wanted}
+    return forecast
+
+
+def get_hourly_forecast(latitude: float, longitude: float, days: int) -> dict:
+    """
+    Makes up an hourly forecast for the passed location in the shape returned by api.open-meteo.com with timeformat=unixtime.
+
+    :param latitude: The latitude of the location.
+    :type latitude: float
+    :param longitude: The longitude of the location.
+    :type longitude: float
+    :param days: The number of days, starting today (UTC), to make up the forecast for.
+    :type days: int
+    :return: The forecast of a single location.
+    """
+    current = get_forecast(latitude, longitude)["current"]
+    midnight = int(time.time()) // 86400 * 86400
+    hours = range(days * 24)
+    return {
+        "latitude": latitude,
+        "longitude": longitude,
+        "utc_offset_seconds": 0,
+        "timezone": "GMT",
+        "hourly": {
+            "time": [midnight + hour * 3600 for hour in hours],
+            "temperature_2m": [round(current["temperature_2m"] + (hour % 24 - 12) / 4, 1) for hour in hours],
+            "apparent_temperature": [round(current["apparent_temperature"] + (hour % 24 - 12) / 4, 1) for hour in hours],
+            "weather_code": [current["weather_code"] for _ in hours],
+            "wind_speed_10m": [current["wind_speed_10m"] for _ in hours],
+            "wind_direction_10m": [current["wind_direction_10m"] for _ in hours],
+            "is_day": [int(6 <= hour % 24 < 18) for hour in hours],
+        },
+        "daily": {
+            "time": [midnight + day * 86400 for day in range(days)],
+            "sunrise": [midnight + day * 86400 + 6 * 3600 for day in range(days)],
+            "sunset": [midnight + day * 86400 + 18 * 3600 for day in range(days)],
+            "temperature_2m_max": [round(current["temperature_2m"] + 3, 1) for _ in range(days)],
+            "temperature_2m_min": [round(current["temperature_2m"] - 3, 1) for _ in range(days)],
+        },
+    }
+
+
+class FakeApiHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers the requests to the fake APIs. The server it belongs to holds the latency, failure rate and request counters.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        url = urllib.parse.urlsplit(self.path)
+        params = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+        with self.server.lock:
+            self.server.requests[url.path] += 1
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.failure_rate and self.server.random.random() < self.server.failure_rate:
+            self.send_json(503, {"error": True, "reason": "injected failure"})
+            return
+
+        if url.path == "/json":
+            self.send_json(200, {"ip": "192.0.2.1", "city": "Potsdam", "region": "Brandenburg", "country": "DE", "loc": "52.3989,13.0657"})
+        elif url.path == "/v1/search":
+            name = params.get("name", "")
+            if name.casefold().startswith("nowhere"):
+                self.send_json(200, {"generationtime_ms": 0.1})
+                return
+            latitude, longitude = get_coordinates(name)
+            self.send_json(200, {"results": [{"name": name, "latitude": latitude, "longitude": longitude, "country_code": params.get("countryCode", "DE")}]})
+        elif url.path == "/v1/forecast":
+            latitudes = [float(value) for value in params["latitude"].split(",")]
+            longitudes = [float(value) for value in params["longitude"].split(",")]
+            if "hourly" in params:
+                forecasts = [get_hourly_forecast(latitude, longitude, int(params.get("forecast_days", 7))) for latitude, longitude in zip(latitudes, longitudes)]
+            else:
+                forecasts = [get_forecast(latitude, longitude, params.get("current"), params.get("daily")) for latitude, longitude in zip(latitudes, longitudes)]
+            for forecast in forecasts:
+                # the parameters missing from a request are left out of the response by the real API
+                for block in ("current", "daily"):
+                    if block not in params:
+                        forecast.pop(block, None)
+            self.send_json(200, forecasts if len(forecasts) > 1 else forecasts[0], cacheable=True)
+        else:
+            self.send_json(404, {"error": True, "reason": "not found"})
+
+    def send_json(self, status: int, data, cacheable: bool = False) -> None:
+        body = json.dumps(data).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if cacheable:
+            headers["ETag"] = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+            headers["Last-Modified"] = email.utils.formatdate(time.time() // UPDATE_INTERVAL * UPDATE_INTERVAL, usegmt=True)
+            if self.server.max_age:
+                headers["Cache-Control"] = f"max-age={self.server.max_age}"
+            if self.headers.get("If-None-Match") == headers["ETag"]:
+                status, body = 304, b""
+
+        accepted = {encoding.strip().split(";")[0] for encoding in self.headers.get("Accept-Encoding", "").split(",")}
+        if body and self.server.compress and "gzip" in accepted:
+            body, headers["Content-Encoding"] = gzip.compress(body, mtime=0), "gzip"
+        elif body and self.server.compress and "deflate" in accepted:
+            body, headers["Content-Encoding"] = zlib.compress(body), "deflate"
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.bytes_sent += len(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class FakeServer(http.server.ThreadingHTTPServer):
+    """
+    The fake APIs, served from a background thread while used as a context manager.
+
+    :param port: The port to listen on. 0 picks a free one.
+    :param latency: The time in seconds to wait before answering each request.
+    :param failure_rate: The share of requests, between 0 and 1, answered with '503 Service Unavailable'.
+    :param seed: The seed for picking the requests that fail.
+    :param compress: Compress the responses if the client accepts it.
+    :param max_age: The max-age of the Cache-Control header sent with forecasts in seconds. 0 sends none.
+    """
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, latency: float = 0.0, failure_rate: float = 0.0, seed: int = 0, compress: bool = True, max_age: int = 0) -> None:
+        super().__init__(("127.0.0.1", port), FakeApiHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.compress = compress
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+        # the bytes of all response bodies, as sent
+        self.bytes_sent = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def environ(self) -> dict[str, str]:
+        """
+        Gets the environment variables pointing rainy at this server.
+
+        :return: The environment variables to add to rainy's environment.
+        """
+        return {
+            "RAINY_IPINFO_URI": self.url + "/json",
+            "RAINY_GEOCODING_URI": self.url + "/v1/search",
+            "RAINY_FORECAST_URI": self.url + "/v1/forecast",
+        }
+
+    def __enter__(self) -> "FakeServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve fake ipinfo.io and Open-Meteo APIs for running rainy offline.")
+    parser.add_argument("--port", type=int, default=8080, help="The port to listen on. Default: 8080")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="The time to wait before answering each request in milliseconds. Default: 0")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="The share of requests answered with 503, between 0 and 1. Default: 0")
+    parser.add_argument("--no-compression", action="store_true", help="Never compress the responses.")
+    parser.add_argument("--max-age", type=int, default=0, help="The max-age of the Cache-Control header sent with forecasts in seconds. Default: 0, which sends none")
+    args = parser.parse_args()
+
+    with FakeServer(args.port, args.latency_ms / 1000, args.failure_rate, compress=not args.no_compression, max_age=args.max_age) as server:
+        for key, value in server.environ().items():
+            print(f"export {key}={value}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
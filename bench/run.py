@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Benchmarks rainy offline against the fake APIs of fake_server.py.
+
+Scenarios:
+  cold    A run with an empty cache, which looks up the location by IP and fetches the forecast.
+  warm    A run served entirely from the cache.
+  format  A run served entirely from the cache, printing a single line with --format, like status bars do.
+  refresh A run whose cached forecast expired, which revalidates it with a conditional request.
+  hourly  A run with an empty cache and mode = hourly, which fetches the multi-day hourly forecast.
+  batch   A run for --cities locations with an empty cache.
+  herd    --herd runs started at the same time with an empty cache, like when a tmux session restores its panes.
+  render  render_weather() alone, called in-process.
+
+Each run of rainy is a separate process with its own cache directory and configuration, so the numbers include the
+interpreter start-up like they do for users. Besides the timings, the API requests and response bytes (as sent,
+so compressed if rainy accepts it) per run are reported. The results are printed as one line per scenario in a fixed order,
+or as JSON lines with --json, so they can be compared between versions.
+
+Usage: python bench/run.py [--runs 20] [--latency-ms 20] [--failure-rate 0] [--cities 20] [--herd 20] [--no-compression] [--json]
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+import configparser
+
+from fake_server import FakeServer
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+RAINY = os.path.join(SRC_DIR, "rainy.py")
+
+# a forecast as returned by get_weather, for the render scenario
+FORECAST = (61, "07:31", "18:12", 11.4, 14.0, 6.2, 9.8, 12.3, 250, True)
+
+
+class Sandbox:
+    """
+    A temporary cache directory and configuration to run rainy in, isolated from the user's own.
+
+    :param server: The fake APIs to point rainy at.
+    :param overrides: Configuration values to change, by section and key.
+    """
+
+    def __init__(self, server: FakeServer, overrides: dict[str, dict[str, str]] | None = None) -> None:
+        self.directory = tempfile.mkdtemp(prefix="rainy-bench-")
+        self.cache_dir = os.path.join(self.directory, "cache")
+        config_path = os.path.join(self.directory, "rainy.conf.ini")
+
+        config = configparser.ConfigParser()
+        config.read(os.path.join(SRC_DIR, "rainy.conf.ini"))
+        for section, values in (overrides or {}).items():
+            if not config.has_section(section):
+                config.add_section(section)
+            for key, value in values.items():
+                config.set(section, key, value)
+        with open(config_path, "w", encoding="utf-8") as file:
+            config.write(file)
+
+        self.env = {
+            **os.environ,
+            **server.environ(),
+            "RAINY_CONFIG": config_path,
+            "XDG_CACHE_HOME": self.cache_dir,
+            "XDG_DATA_HOME": os.path.join(self.directory, "data"),
+            "XDG_RUNTIME_DIR": self.directory,
+        }
+
+    def clear_cache(self) -> None:
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def expire_forecasts(self) -> None:
+        """
+        Makes the cached forecasts look like they were fetched long ago, so the next run has to revalidate them.
+        """
+        for path in glob.glob(os.path.join(self.cache_dir, "rainy", "weather_*.json")):
+            with open(path, encoding="utf-8") as file:
+                entry = json.load(file)
+            entry["fetched_at"] = 0
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(entry, file)
+
+    def start(self, *args: str) -> subprocess.Popen:
+        """
+        Starts rainy with the passed CLI arguments without waiting for it.
+
+        :return: The started process.
+        """
+        return subprocess.Popen([sys.executable, RAINY, *args], env=self.env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def run(self, *args: str) -> tuple[float, bool]:
+        """
+        Runs rainy with the passed CLI arguments.
+
+        :returns: tuple: The wall time in milliseconds on index 0 and whether rainy succeeded on index 1.
+        """
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, RAINY, *args], env=self.env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return (time.perf_counter() - start) * 1000, result.returncode == 0
+
+    def close(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def summarize(name: str, timings: list[float], failures: int, requests: int, bytes_sent: int = 0) -> dict:
+    """
+    Summarizes the timings of a scenario.
+
+    :return: The name, number of runs, median, 95th percentile and minimum in milliseconds, failed runs, API requests and response bytes per run.
+    """
+    timings = sorted(timings)
+    p95 = statistics.quantiles(timings, n=20, method="inclusive")[18] if len(timings) > 1 else timings[0]
+    return {
+        "scenario": name,
+        "runs": len(timings),
+        "median_ms": round(statistics.median(timings), 3),
+        "p95_ms": round(p95, 3),
+        "min_ms": round(timings[0], 3),
+        "failures": failures,
+        "requests_per_run": round(requests / len(timings), 2),
+        "bytes_per_run": round(bytes_sent / len(timings)),
+    }
+
+
+def bench_process(name: str, server: FakeServer, sandbox: Sandbox, runs: int, args: list[str], cold: bool, expire: bool = False) -> dict:
+    """
+    Runs rainy as a separate process runs times.
+
+    :param cold: Clear the cache before every run. Otherwise it is filled by an extra run first.
+    :param expire: Expire the cached forecasts before every run, see Sandbox.expire_forecasts.
+    :return: The summary of the scenario.
+    """
+    if not cold:
+        sandbox.run(*args)
+
+    timings = []
+    failures = 0
+    requests_before = sum(server.requests.values())
+    bytes_before = server.bytes_sent
+    for _ in range(runs):
+        if cold:
+            sandbox.clear_cache()
+        if expire:
+            sandbox.expire_forecasts()
+        elapsed, succeeded = sandbox.run(*args)
+        timings.append(elapsed)
+        failures += not succeeded
+    return summarize(name, timings, failures, sum(server.requests.values()) - requests_before, server.bytes_sent - bytes_before)
+
+
+def bench_herd(server: FakeServer, sandbox: Sandbox, runs: int, processes: int) -> dict:
+    """
+    Starts processes runs of rainy at the same time, runs times. Each time is measured until the last one finished.
+
+    :return: The summary of the scenario.
+    """
+    timings = []
+    failures = 0
+    requests_before = sum(server.requests.values())
+    bytes_before = server.bytes_sent
+    for _ in range(runs):
+        sandbox.clear_cache()
+        start = time.perf_counter()
+        started = [sandbox.start() for _ in range(processes)]
+        failures += sum(process.wait() != 0 for process in started)
+        timings.append((time.perf_counter() - start) * 1000)
+    return summarize("herd", timings, failures, sum(server.requests.values()) - requests_before, server.bytes_sent - bytes_before)
+
+
+def bench_render(sandbox: Sandbox, runs: int, loops: int = 1000) -> dict:
+    """
+    Times render_weather in this process. Each run renders loops times; the time per render is reported.
+
+    :return: The summary of the scenario.
+    """
+    os.environ["RAINY_CONFIG"] = sandbox.env["RAINY_CONFIG"]
+    sys.path.insert(0, SRC_DIR)
+    import rainy
+
+    config = rainy.load_config()
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        for _ in range(loops):
+            rainy.render_weather(config, "Potsdam", FORECAST)
+        timings.append((time.perf_counter() - start) * 1000 / loops)
+    return summarize("render", timings, 0, 0)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark rainy offline against fake APIs.")
+    parser.add_argument("--runs", type=int, default=20, help="How often each scenario is run. Default: 20")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="The latency of the fake APIs in milliseconds. Default: 20")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="The share of API requests failing with 503, between 0 and 1. Default: 0")
+    parser.add_argument("--cities", type=int, default=20, help="The number of locations in the batch scenario. Default: 20")
+    parser.add_argument("--herd", type=int, default=20, help="The number of runs started at the same time in the herd scenario. Default: 20")
+    parser.add_argument("--no-compression", action="store_true", help="Make the fake APIs never compress their responses.")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON lines.")
+    args = parser.parse_args()
+
+    overrides = {
+        "Cache": {"weather_ttl": "3600", "weather_hard_ttl": "3600"},
+        "Network": {"backoff": "0.01"},
+    }
+    with FakeServer(latency=args.latency_ms / 1000, failure_rate=args.failure_rate, compress=not args.no_compression) as server:
+        sandbox = Sandbox(server, overrides)
+        hourly_sandbox = Sandbox(server, {**overrides, "Forecast": {"mode": "hourly"}})
+        try:
+            results = [
+                bench_process("cold", server, sandbox, args.runs, [], cold=True),
+                bench_process("warm", server, sandbox, args.runs, [], cold=False),
+                bench_process("format", server, sandbox, args.runs, ["--format", "{emoji} {temperature} {wind_speed}"], cold=False),
+                bench_process("refresh", server, sandbox, args.runs, [], cold=False, expire=True),
+                bench_process("hourly", server, hourly_sandbox, args.runs, [], cold=True),
+                bench_process("batch", server, sandbox, args.runs, ["--city-name", *(f"Site {i}" for i in range(args.cities)), "--table"], cold=True),
+                bench_herd(server, sandbox, args.runs, args.herd),
+                bench_render(sandbox, args.runs),
+            ]
+        finally:
+            sandbox.close()
+            hourly_sandbox.close()
+
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+        return
+
+    print(f"{'scenario':<10}{'runs':>6}{'median_ms':>12}{'p95_ms':>12}{'min_ms':>12}{'failures':>10}{'requests/run':>14}{'bytes/run':>11}")
+    for result in results:
+        print(f"{result['scenario']:<10}{result['runs']:>6}{result['median_ms']:>12.3f}{result['p95_ms']:>12.3f}{result['min_ms']:>12.3f}{result['failures']:>10}{result['requests_per_run']:>14.2f}{result['bytes_per_run']:>11}")
+
+
+if __name__ == "__main__":
+    main()
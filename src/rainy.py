@@ -1,51 +1,781 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
+
 import os
-import requests
-import datetime
-import emoji
-import termcolor
-import argparse
-import configparser
+import sys
+import time
+
+# when rainy started executing, so the time spent importing it is part of the timings
+_started = time.perf_counter()
+
+
+def get_cache_dir() -> str:
+    """
+    Gets the directory rainy stores its cache files in.
+    On Linux this follows the XDG Base Directory Specification ($XDG_CACHE_HOME/rainy, by default ~/.cache/rainy).
+    On Windows it is %LOCALAPPDATA%\\rainy\\cache.
+
+    :return: The absolute path of the cache directory. It is not guaranteed to exist.
+    """
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+        return os.path.join(base, "rainy", "cache")
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "rainy")
+
+
+def get_data_dir() -> str:
+    """
+    Gets the directory rainy stores data in that can't be fetched again, like the history of observations.
+    On Linux this follows the XDG Base Directory Specification ($XDG_DATA_HOME/rainy, by default ~/.local/share/rainy).
+    On Windows it is %LOCALAPPDATA%\\rainy\\data.
+
+    :return: The absolute path of the data directory. It is not guaranteed to exist.
+    """
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+        return os.path.join(base, "rainy", "data")
+    base = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(base, "rainy")
+
+
+def get_socket_path() -> str:
+    """
+    Gets the path of the Unix socket the daemon listens on.
+    It is placed in $XDG_RUNTIME_DIR if set, otherwise in the cache directory.
+
+    :return: The absolute path of the socket.
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "rainy.sock")
+    return os.path.join(get_cache_dir(), "rainy.sock")
+
+
+def run_client() -> bool:
+    """
+    Prints the output rendered by a running rainy daemon.
+    Only the standard library is needed for this, so it's fast enough to be run on every terminal start.
+
+    :return: True if the output was printed, False if no daemon could be reached.
+    """
+    import socket
+
+    if not hasattr(socket, "AF_UNIX"):
+        return False
+
+    chunks = []
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(2)
+            sock.connect(get_socket_path())
+            # tell the daemon whether the output may be colored
+            sock.sendall(b"color\n" if sys.stdout.isatty() else b"\n")
+            while chunk := sock.recv(65536):
+                chunks.append(chunk)
+    except OSError:
+        return False
+
+    sys.stdout.buffer.write(b"".join(chunks))
+    sys.stdout.flush()
+    return True
+
+
+# `rainy --client` is handled before anything else, so it starts as fast as possible.
+# If no daemon is running, rainy continues with a normal run.
+if __name__ == "__main__" and sys.argv[1:] == ["--client"] and run_client():
+    sys.exit(0)
+
+# Everything else, above all requests, is imported by the functions that need it, so cached runs don't pay for it.
+import json
+import contextlib
+
+
+class Trace:
+    """
+    Collects how long each phase of a run takes, for --timings and --trace-file.
+    The time spent importing rainy and the modules it imports on demand is recorded separately from the phases.
+    If enabled, every request and cache lookup is recorded as well.
+
+    :param started: When rainy started executing, as returned by time.perf_counter.
+    """
+
+    def __init__(self, started: float) -> None:
+        self.enabled = False
+        self.started = started
+        self.records: list[dict] = []
+
+    def elapsed_ms(self, since: float | None = None) -> float:
+        return round((time.perf_counter() - (self.started if since is None else since)) * 1000, 3)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """
+        Records the time spent in the with-block as the phase with the passed name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.records.append({"type": "phase", "name": name, "start_ms": round((start - self.started) * 1000, 3), "ms": self.elapsed_ms(start)})
+
+    @contextlib.contextmanager
+    def importing(self, name: str):
+        """
+        Records the time spent in the with-block as the import of the module with the passed name, unless it was imported before.
+        Modules are imported on demand by the phases needing them, so this time is part of these phases as well.
+        """
+        if name in sys.modules:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.records.append({"type": "import", "name": name, "start_ms": round((start - self.started) * 1000, 3), "ms": self.elapsed_ms(start)})
+
+    def record(self, kind: str, **fields) -> None:
+        """
+        Records a request, cache lookup or anything else of interest, if enabled.
+        """
+        if self.enabled:
+            self.records.append({"type": kind, "at_ms": self.elapsed_ms(), **fields})
+
+    def format_timings(self) -> str:
+        """
+        Formats the recorded data as a human-readable breakdown.
+
+        :return: The breakdown, each line terminated by a newline.
+        """
+        lines = ["rainy timings (ms)"]
+        for record in sorted((record for record in self.records if record["type"] == "phase"), key=lambda record: record["start_ms"]):
+            lines.append(f"  {record['name']:<16}{record['ms']:>10.3f}")
+        lines.append(f"  {'total':<16}{self.elapsed_ms():>10.3f}")
+        imports = [record for record in self.records if record["type"] == "import"]
+        if imports:
+            lines.append(f"  imported on demand, part of the phases above: {sum(record['ms'] for record in imports):.3f}")
+            for record in imports:
+                lines.append(f"    {record['name']:<14}{record['ms']:>10.3f}")
+        for record in self.records:
+            if record["type"] == "request":
+                connection = "reused connection" if record.get("reused") else "new connection"
+                lines.append(f"  GET {record['url']} -> {record.get('status', record.get('error'))}, {record.get('bytes', 0)} bytes ({record.get('wire_bytes', 0)} on the wire, {record.get('encoding', 'identity')}), {connection}, {record['ms']:.3f} ms")
+            elif record["type"] == "cache":
+                lines.append(f"  cache {record['name']}: {'hit' if record['hit'] else 'miss'}")
+            elif record["type"] == "lock":
+                lines.append(f"  lock {record['name']}: {'acquired' if record['locked'] else 'timed out'} after {record['ms']:.3f} ms")
+        return "".join(line + "\n" for line in lines)
+
+    def write_trace_file(self, path: str) -> None:
+        """
+        Appends the recorded data to the passed file as JSON lines, one object per record.
+        Every object contains the time and process id of the run, so files of multiple runs and hosts can be aggregated.
+
+        :param path: The path of the file to append to.
+        :type path: str
+        :return: None
+        """
+        run = {"time": round(time.time(), 3), "pid": os.getpid()}
+        records = self.records + [{"type": "phase", "name": "total", "start_ms": 0.0, "ms": self.elapsed_ms()}]
+        with open(path, "a", encoding="utf-8") as file:
+            file.write("".join(json.dumps({**run, **record}) + "\n" for record in records))
+
+
+# timings of the current run
+trace = Trace(_started)
+
+
+# every key of the configuration: its section and option in rainy.conf.ini, its type and the default used if it is missing or invalid
+CONFIG_KEYS = {
+    # Location
+    "city_name": ("Location", "city_name", str, ""),
+    "country_code": ("Location", "country_code", str, ""),
+
+    # Units
+    "temperature_unit": ("Units", "temperature_unit", str, "C"),
+    "speed_unit": ("Units", "speed_unit", str, "km/h"),
+
+    # Formats
+    "date_format": ("Formats", "date_format", str, "DD.MM.YYYY"),
+    "time_format": ("Formats", "time_format", int, 24),
+
+    # What to show
+    "show_city": ("Show", "show_city", bool, True),
+    "show_weather": ("Show", "show_weather", bool, True),
+    "show_temperature": ("Show", "show_temperature", bool, True),
+    "show_apparent_temperature": ("Show", "show_apparent_temperature", bool, False),
+    "show_max_and_min_temperature": ("Show", "show_max_and_min_temperature", bool, True),
+    "show_wind_speed": ("Show", "show_wind_speed", bool, True),
+    "show_wind_direction": ("Show", "show_wind_direction", bool, True),
+    "show_sunrise": ("Show", "show_sunrise", bool, True),
+    "show_sunset": ("Show", "show_sunset", bool, True),
+    "show_date": ("Show", "show_date", bool, True),
+    "show_time": ("Show", "show_time", bool, True),
+
+    # Output options
+    "use_emoji": ("Output", "use_emoji", bool, True),
+    "use_color": ("Output", "use_color", bool, False),
+    "show_ascii_art": ("Output", "show_ascii_art", bool, True),
+    "theme": ("Output", "theme", str, ""),
+
+    # Cache
+    "weather_ttl": ("Cache", "weather_ttl", int, 600),
+    "weather_hard_ttl": ("Cache", "weather_hard_ttl", int, 10800),
+    "location_ttl": ("Cache", "location_ttl", int, 2592000),
+
+    # Network
+    "connect_timeout": ("Network", "connect_timeout", float, 3.05),
+    "read_timeout": ("Network", "read_timeout", float, 5.0),
+    "retries": ("Network", "retries", int, 2),
+    "backoff": ("Network", "backoff", float, 0.5),
+    "lock_timeout": ("Network", "lock_timeout", float, 10.0),
+
+    # Quota
+    "open_meteo_per_minute": ("Quota", "open_meteo_per_minute", int, 600),
+    "open_meteo_per_day": ("Quota", "open_meteo_per_day", int, 10000),
+    "ipinfo_per_month": ("Quota", "ipinfo_per_month", int, 50000),
+
+    # Forecast
+    "forecast_mode": ("Forecast", "mode", str, "current"),
+    "forecast_days": ("Forecast", "forecast_days", int, 3),
+    "hourly_refresh_after": ("Forecast", "refresh_after", int, 43200),
+
+    # Daemon
+    "refresh_interval": ("Daemon", "refresh_interval", int, 300),
+
+    # Batch
+    "batch_workers": ("Batch", "batch_workers", int, 4),
+}
+
+# the strftime patterns of each date_format
+DATE_PATTERNS = {
+    "MM/DD/YYYY": "%m/%d/%Y",
+    "DD/MM/YYYY": "%d/%m/%Y",
+    "YYYY/MM/DD": "%Y/%m/%d",
+    "YYYY-MM-DD": "%Y-%m-%d",
+    "DD.MM.YYYY": "%d.%m.%Y",
+}
+
+# the strftime patterns of the current time and of times of day like the sunrise for each time_format
+TIME_PATTERNS = {
+    12: ("%I:%M:%S %p", "%I:%M %p"),
+    24: ("%H:%M:%S", "%H:%M"),
+}
+
+
+def compile_config(path: str) -> tuple[dict, list[str]]:
+    """
+    Parses and validates the configuration file at the passed path.
+    Missing and invalid values are replaced by their defaults from CONFIG_KEYS. Values derived from the configuration, like the unit conversions and the date and time patterns, are resolved as well.
+
+    :param path: The path of rainy.conf.ini.
+    :type path: str
+    :returns: tuple: The configuration on index 0 and the warnings about invalid values on index 1.
+    """
+    with trace.importing("configparser"):
+        import configparser
 
-def load_config():
     parser = configparser.ConfigParser()
-    parser.read(os.path.join(os.path.dirname(__file__), "rainy.conf.ini"))
-
-    # load configuration
-    cfg = {
-        # Location
-        "city_name": parser.get("Location", "city_name"),
-        "country_code": parser.get("Location", "country_code"),
-
-        # Units
-        "temperature_unit": "°" + parser.get("Units", "temperature_unit"),
-        "speed_unit": parser.get("Units", "speed_unit"),
-
-        # Formats
-        "date_format": parser.get("Formats", "date_format"),
-        "time_format": parser.getint("Formats", "time_format"),
-
-        # What to show
-        "show_city": parser.getboolean("Show", "show_city"),
-        "show_weather": parser.getboolean("Show", "show_weather"),
-        "show_temperature": parser.getboolean("Show", "show_temperature"),
-        "show_apparent_temperature": parser.getboolean("Show", "show_apparent_temperature"),
-        "show_max_and_min_temperature": parser.getboolean("Show", "show_max_and_min_temperature"),
-        "show_wind_speed": parser.getboolean("Show", "show_wind_speed"),
-        "show_wind_direction": parser.getboolean("Show", "show_wind_direction"),
-        "show_sunrise": parser.getboolean("Show", "show_sunrise"),
-        "show_sunset": parser.getboolean("Show", "show_sunset"),
-        "show_date": parser.getboolean("Show", "show_date"),
-        "show_time": parser.getboolean("Show", "show_time"),
-
-        # Output options
-        "use_emoji": parser.getboolean("Output", "use_emoji"),
-        "use_color": parser.getboolean("Output", "use_color"),
-        "show_ascii_art": parser.getboolean("Output", "show_ascii_art"),
-    }
+    warnings = []
+    try:
+        parser.read(path, encoding="utf-8")
+    except configparser.Error as error:
+        warnings.append(f"Couldn't read the configuration: {error}. Using default.")
+
+    cfg = {}
+    for key, (section, option, value_type, default) in CONFIG_KEYS.items():
+        try:
+            if value_type is bool:
+                value = parser.getboolean(section, option, fallback=default)
+            elif value_type is int:
+                value = parser.getint(section, option, fallback=default)
+            elif value_type is float:
+                value = parser.getfloat(section, option, fallback=default)
+            else:
+                value = parser.get(section, option, fallback=default).strip()
+        except ValueError:
+            warnings.append(f"Invalid value {parser.get(section, option)!r} for {option} in [{section}]. Using default: {default}.")
+            value = default
+        cfg[key] = value
+
+    # derived values
+    if "°" + cfg["temperature_unit"] not in TEMPERATURE_CONVERSIONS:
+        warnings.append("Invalid temperature unit. Please use supported unit. Using default.")
+        cfg["temperature_unit"] = "C"
+    cfg["temperature_unit"] = "°" + cfg["temperature_unit"]
+    cfg["temperature_conversion"] = list(TEMPERATURE_CONVERSIONS[cfg["temperature_unit"]])
+
+    if cfg["speed_unit"].lower() not in SPEED_CONVERSIONS:
+        warnings.append("Invalid wind speed unit. Please use supported unit. Using default.")
+        cfg["speed_unit"] = "km/h"
+    cfg["speed_conversion"] = SPEED_CONVERSIONS[cfg["speed_unit"].lower()]
+
+    if cfg["date_format"] not in DATE_PATTERNS:
+        warnings.append("Invalid date format. Please use supported date format. Using default.")
+        cfg["date_format"] = "DD.MM.YYYY"
+    cfg["date_pattern"] = DATE_PATTERNS[cfg["date_format"]]
+
+    if cfg["time_format"] not in TIME_PATTERNS:
+        warnings.append("Invalid time format. Please use supported time format. Using default.")
+        cfg["time_format"] = 24
+    cfg["time_pattern"], cfg["time_of_day_pattern"] = TIME_PATTERNS[cfg["time_format"]]
+
+    if cfg["forecast_mode"] not in ("current", "hourly"):
+        warnings.append("Invalid forecast mode. Please use supported mode. Using default.")
+        cfg["forecast_mode"] = "current"
+
+    cfg["theme"] = os.path.expanduser(cfg["theme"])
+
+    return cfg, warnings
+
+
+def load_config():
+    """
+    Loads the configuration from rainy.conf.ini next to rainy, or from the file set in the RAINY_CONFIG environment variable.
+    Parsing it with configparser takes longer than the rest of a cached run, so the compiled configuration is cached and only compiled again,
+    using compile_config, when the size or modification time of the file or of rainy itself changes. Warnings about invalid values are cached as well and printed to stderr on every run.
+
+    :return: The configuration.
+    """
+    import zlib
+
+    path = os.path.abspath(os.environ.get("RAINY_CONFIG") or os.path.join(os.path.dirname(__file__), "rainy.conf.ini"))
+    try:
+        config_stat = os.stat(path)
+        key = [config_stat.st_mtime_ns, config_stat.st_size, os.stat(__file__).st_mtime_ns]
+    except OSError:
+        key = None
+
+    cache_name = f"config_{zlib.crc32(path.encode('utf-8')):08x}"
+    entry = read_cache(cache_name, None) if key is not None else None
+    if entry is not None and entry["data"].get("path") == path and entry["data"].get("key") == key:
+        cfg, warnings = entry["data"]["config"], entry["data"]["warnings"]
+    else:
+        cfg, warnings = compile_config(path)
+        if key is not None:
+            write_cache(cache_name, {"path": path, "key": key, "config": cfg, "warnings": warnings})
+
+    # on stderr, so they don't end up in the single line of --format and --json
+    for warning in warnings:
+        print(warning, file=sys.stderr)
     return cfg
 
+
+def read_cache(name: str, ttl: float | None) -> dict | None:
+    """
+    Reads the cache entry with the passed name.
+    Entries older than the passed ttl are treated as if they did not exist.
+
+    :param name: The name of the cache entry.
+    :type name: str
+    :param ttl: The maximum age of the entry in seconds. If None, the entry is returned regardless of its age.
+    :type ttl: float
+    :return: The cache entry containing the time it was fetched at ('fetched_at') and its 'data', or None if there is no usable entry.
+    """
+    try:
+        with open(os.path.join(get_cache_dir(), name + ".json"), encoding="utf-8") as file:
+            entry = json.load(file)
+    except (OSError, ValueError):
+        entry = None
+
+    if not isinstance(entry, dict) or "data" not in entry:
+        entry = None
+    elif ttl is not None and time.time() - entry.get("fetched_at", 0) > ttl:
+        entry = None
+    trace.record("cache", name=name, hit=entry is not None)
+    return entry
+
+
+def write_file_atomically(path: str, data: bytes) -> None:
+    """
+    Writes the passed data to the file at the passed path.
+    The data is written to a temporary file in the same directory first and then moved in place, so concurrent runs never see a partially written file.
+
+    :param path: The path of the file to write. Its directory is created if needed.
+    :type path: str
+    :param data: The content of the file.
+    :type data: bytes
+    :return: None
+    :raises OSError: If the file can't be written.
+    """
+    import tempfile
+
+    directory, name = os.path.split(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_cache(name: str, data) -> None:
+    """
+    Writes the passed data to the cache entry with the passed name.
+    The entry is written atomically, so concurrent runs never see a partially written entry.
+    The cache is best-effort: If it can't be written, rainy will just fetch the data again next time.
+
+    :param name: The name of the cache entry.
+    :type name: str
+    :param data: Any JSON serializable data to store.
+    :return: None
+    """
+    try:
+        write_file_atomically(os.path.join(get_cache_dir(), name + ".json"), json.dumps({"fetched_at": time.time(), "data": data}).encode("utf-8"))
+    except OSError:
+        pass
+
+
+def lock_file(file, timeout: float) -> bool:
+    """
+    Locks the passed file exclusively. While another process holds the lock, it is retried until timeout seconds have passed.
+
+    :param file: The file to lock, opened for writing.
+    :param timeout: The maximum time in seconds to wait for the lock.
+    :type timeout: float
+    :return: True if the file was locked, False if the timeout passed.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if os.name == "nt":
+                import msvcrt
+
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.02)
+
+
+@contextlib.contextmanager
+def cache_lock(name: str):
+    """
+    Makes sure only one rainy process at a time fetches the cache entry with the passed name.
+    The others wait for it inside their with-block and should check the cache again before fetching themselves.
+    If the lock isn't released within network_settings["lock_timeout"] seconds, the with-block runs without it, so a hanging process can't block every other one.
+
+    :param name: The name of the cache entry.
+    :type name: str
+    """
+    cache_dir = get_cache_dir()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        file = open(os.path.join(cache_dir, name + ".lock"), "a+b")
+    except OSError:
+        yield
+        return
+
+    with file:
+        start = time.perf_counter()
+        locked = lock_file(file, network_settings["lock_timeout"])
+        trace.record("lock", name=name, locked=locked, ms=trace.elapsed_ms(start))
+        try:
+            yield
+        finally:
+            if locked:
+                if os.name == "nt":
+                    import msvcrt
+
+                    file.seek(0)
+                    msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+                else:
+                    import fcntl
+
+                    fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+class FetchError(Exception):
+    """
+    Raised if an API can't be reached or answers with an error, even after retrying.
+    """
+
+
+class QuotaExceededError(FetchError):
+    """
+    Raised instead of sending a request that would exceed the limits of an API, see acquire_quota.
+    Like any other FetchError, it makes rainy fall back to cached data.
+    """
+
+
+# the API each endpoint counts against, as the limits apply to all endpoints of an API together
+QUOTA_APIS = {
+    "forecast": "open-meteo",
+    "geocoding": "open-meteo",
+    "ipinfo": "ipinfo",
+}
+
+
+def get_quota_limits(api: str) -> dict[str, int]:
+    """
+    Gets the limits of the passed API from network_settings. A limit of 0 or less means unlimited.
+
+    :return: The number of requests allowed per 'minute', 'day' and 'month'.
+    """
+    if api == "open-meteo":
+        return {"minute": network_settings["open_meteo_per_minute"], "day": network_settings["open_meteo_per_day"], "month": 0}
+    elif api == "ipinfo":
+        return {"minute": 0, "day": 0, "month": network_settings["ipinfo_per_month"]}
+    return {"minute": 0, "day": 0, "month": 0}
+
+
+@contextlib.contextmanager
+def quota_state():
+    """
+    Gives exclusive access to the quota state shared by all rainy processes on the host, which is stored in quota.json in the cache directory.
+    Changes to the yielded state are written back at the end of the with-block. Daily and monthly counters are reset when a new day or month (UTC) starts.
+    The state is best-effort: If it can't be read, counting starts over; if it can't be written, the changes are lost.
+    """
+    path = os.path.join(get_cache_dir(), "quota.json")
+    with cache_lock("quota"):
+        try:
+            with open(path, encoding="utf-8") as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            state = {}
+
+        day = time.strftime("%Y-%m-%d", time.gmtime())
+        for period, current in (("day", day), ("month", day[:7])):
+            if state.get(period) != current:
+                state[period] = current
+                for counters in (*state.get("apis", {}).values(), *state.get("endpoints", {}).values()):
+                    counters[period] = 0
+                    counters.pop("limited_" + period, None)
+
+        yield state
+        try:
+            write_file_atomically(path, json.dumps(state).encode("utf-8"))
+        except OSError:
+            pass
+
+
+def acquire_quota(endpoint: str) -> None:
+    """
+    Takes one request to the passed endpoint out of the host-wide budget of its API, or raises if the budget is used up.
+    The per-minute limit is a token bucket, so short bursts are fine; if the next token is less than a second away, it is waited for.
+    The daily and monthly limits are counters. While the API has answered '429 Too Many Requests', no request is sent until its Retry-After passed.
+
+    :param endpoint: The endpoint to request, a key of QUOTA_APIS.
+    :type endpoint: str
+    :return: None
+    :raises QuotaExceededError: If the request would exceed a limit.
+    """
+    api = QUOTA_APIS[endpoint]
+    limits = get_quota_limits(api)
+    while True:
+        with quota_state() as state:
+            now = time.time()
+            counters = state.setdefault("apis", {}).setdefault(api, {"day": 0, "month": 0})
+            if counters.get("blocked_until", 0) > now:
+                raise QuotaExceededError(f"{api} is rate limiting requests until {time.strftime('%H:%M:%S', time.localtime(counters['blocked_until']))}.")
+            for period in ("day", "month"):
+                if 0 < limits[period] <= counters.get(period, 0):
+                    raise QuotaExceededError(f"The limit of {limits[period]} requests per {period} to {api} has been used up.")
+
+            wait = 0.0
+            if limits["minute"] > 0:
+                rate = limits["minute"] / 60
+                tokens = min(limits["minute"], counters.get("tokens", limits["minute"]) + (now - counters.get("updated", now)) * rate)
+                # the tokens accrued until now are kept, whether one is taken or not
+                counters["updated"] = now
+                counters["tokens"] = tokens
+                if tokens < 1:
+                    wait = (1 - tokens) / rate
+                    if wait > 1:
+                        raise QuotaExceededError(f"The limit of {limits['minute']} requests per minute to {api} has been used up.")
+                else:
+                    counters["tokens"] = tokens - 1
+
+            if not wait:
+                endpoint_counters = state.setdefault("endpoints", {}).setdefault(endpoint, {"day": 0, "month": 0})
+                for period in ("day", "month"):
+                    counters[period] = counters.get(period, 0) + 1
+                    endpoint_counters[period] = endpoint_counters.get(period, 0) + 1
+                return
+        time.sleep(wait)
+
+
+def record_rate_limited(endpoint: str, retry_after: str | None) -> None:
+    """
+    Records that the passed endpoint answered '429 Too Many Requests', so no rainy process on the host sends requests to its API until Retry-After passed.
+
+    :param endpoint: The endpoint requested, a key of QUOTA_APIS.
+    :type endpoint: str
+    :param retry_after: The Retry-After header of the response in seconds, if any. Defaults to 60 seconds.
+    :type retry_after: str
+    :return: None
+    """
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = 60.0
+    with quota_state() as state:
+        counters = state.setdefault("apis", {}).setdefault(QUOTA_APIS[endpoint], {"day": 0, "month": 0})
+        counters["blocked_until"] = max(counters.get("blocked_until", 0), time.time() + delay)
+        endpoint_counters = state.setdefault("endpoints", {}).setdefault(endpoint, {"day": 0, "month": 0})
+        for period in ("day", "month"):
+            endpoint_counters["limited_" + period] = endpoint_counters.get("limited_" + period, 0) + 1
+
+
+def format_quota() -> str:
+    """
+    Formats the requests sent by all rainy processes on the host today and this month (UTC) against the limits of each API, for --quota.
+
+    :return: The report, each line terminated by a newline.
+    """
+    with quota_state() as state:
+        now = time.time()
+        lines = [f"Requests sent by rainy on this host (UTC day {state['day']}):"]
+        for api in dict.fromkeys(QUOTA_APIS.values()):
+            limits = get_quota_limits(api)
+            counters = state.get("apis", {}).get(api, {})
+            usage = []
+            for period, label in (("day", "today"), ("month", "this month")):
+                used = counters.get(period, 0)
+                usage.append(f"{used} of {limits[period]} {label}" if limits[period] > 0 else f"{used} {label}")
+            if limits["minute"] > 0:
+                tokens = min(limits["minute"], counters.get("tokens", limits["minute"]) + (now - counters.get("updated", now)) * limits["minute"] / 60)
+                usage.append(f"{int(tokens)} of {limits['minute']} per minute available")
+            if counters.get("blocked_until", 0) > now:
+                usage.append(f"rate limited until {time.strftime('%H:%M:%S', time.localtime(counters['blocked_until']))}")
+            lines.append(f"  {api}: {', '.join(usage)}")
+            for endpoint in (endpoint for endpoint, endpoint_api in QUOTA_APIS.items() if endpoint_api == api):
+                endpoint_counters = state.get("endpoints", {}).get(endpoint, {})
+                lines.append(
+                    f"    {endpoint}: {endpoint_counters.get('day', 0)} today ({endpoint_counters.get('limited_day', 0)} rate limited),"
+                    f" {endpoint_counters.get('month', 0)} this month ({endpoint_counters.get('limited_month', 0)} rate limited)"
+                )
+    return "".join(line + "\n" for line in lines)
+
+
+# settings of the shared HTTP session, overwritten by configure_network()
+network_settings = {
+    "connect_timeout": 3.05,
+    "read_timeout": 5.0,
+    "retries": 2,
+    "backoff": 0.5,
+    "lock_timeout": 10.0,
+    "open_meteo_per_minute": 600,
+    "open_meteo_per_day": 10000,
+    "ipinfo_per_month": 50000,
+}
+_session = None
+
+
+def configure_network(config) -> None:
+    """
+    Applies the network settings of the passed configuration to every following request.
+
+    :param config: The configuration returned by load_config.
+    :type config: dict
+    :return: None
+    """
+    for key in network_settings:
+        network_settings[key] = config.get(key, network_settings[key])
+
+
+def get_session() -> requests.Session:
+    """
+    Gets the HTTP session shared by all API calls.
+    The session keeps connections alive, so consecutive calls to the same host skip the TCP and TLS handshake.
+
+    :return: The shared requests.Session. It is created on the first call.
+    """
+    global _session
+    if _session is None:
+        with trace.importing("requests"):
+            import requests
+            import requests.adapters
+
+        _session = requests.Session()
+        # both are decoded by urllib3 itself; others, like brotli, would need optional packages
+        _session.headers["Accept-Encoding"] = "gzip, deflate"
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=0)
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+    return _session
+
+
+def count_connections() -> int:
+    """
+    Counts the connections the shared session has opened so far. If it doesn't change during a request, the request reused a kept-alive connection.
+
+    :return: The number of connections opened.
+    """
+    pool_manager = get_session().get_adapter("https://").poolmanager
+    return sum(pool_manager.pools[key].num_connections for key in pool_manager.pools.keys())
+
+
+def http_get(uri: str, params: dict | None = None, endpoint: str | None = None, headers: dict | None = None) -> requests.Response:
+    """
+    Sends a GET request over the shared session.
+    Connection errors, timeouts, 429 and 5xx responses are retried up to network_settings["retries"] times with exponential backoff and full jitter.
+    If an endpoint is passed, every attempt is taken out of the host-wide quota of its API first, see acquire_quota.
+    A 429 response to such a request isn't retried: it blocks all requests to the API until its Retry-After passed, see record_rate_limited.
+
+    :param uri: The URI to request.
+    :type uri: str
+    :param params: The query parameters to send.
+    :type params: dict
+    :param endpoint: The endpoint to count the request against, a key of QUOTA_APIS.
+    :type endpoint: str
+    :param headers: Additional headers to send, like the validators of a conditional request.
+    :type headers: dict
+    :return: The response. Its status code is below 400.
+    :raises FetchError: If the request still fails after the last retry.
+    :raises QuotaExceededError: If the request would exceed the limits of the API.
+    """
+    import random
+
+    with trace.importing("requests"):
+        import requests
+
+    timeout = (network_settings["connect_timeout"], network_settings["read_timeout"])
+    retries = max(0, network_settings["retries"])
+    for attempt in range(retries + 1):
+        if endpoint is not None:
+            acquire_quota(endpoint)
+        start = time.perf_counter()
+        if trace.enabled:
+            connections_before = count_connections()
+        try:
+            response = get_session().get(uri, params=params, headers=headers, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            trace.record("request", url=uri, attempt=attempt, error=type(error).__name__, ms=trace.elapsed_ms(start))
+            if attempt == retries:
+                raise FetchError(str(error)) from error
+        except requests.RequestException as error:
+            raise FetchError(str(error)) from error
+        else:
+            if trace.enabled:
+                trace.record(
+                    "request", url=uri, attempt=attempt, status=response.status_code, bytes=len(response.content),
+                    wire_bytes=response.raw.tell(), encoding=response.headers.get("Content-Encoding", "identity"),
+                    reused=count_connections() == connections_before, ms=trace.elapsed_ms(start)
+                )
+            if response.status_code == 429 and endpoint is not None:
+                # every rainy process on the host stops asking the API until Retry-After passed, so a retry would only be refused by acquire_quota
+                record_rate_limited(endpoint, response.headers.get("Retry-After"))
+                break
+            if attempt == retries or (response.status_code != 429 and response.status_code < 500):
+                break
+        time.sleep(random.uniform(0, network_settings["backoff"] * 2 ** attempt))
+
+    if response.status_code >= 400:
+        raise FetchError(f"{response.status_code} {response.reason} for url: {response.url}")
+    return response
+
+
 def get_location_by_ip() -> tuple[float, float, str]:
     """
     Gets the current location of the user based on his public IP Address using the ipinfo.io API.
@@ -55,9 +785,8 @@ def get_location_by_ip() -> tuple[float, float, str]:
 
     :returns: tuple: It contains the latitude on index 0, longitude on index 1 and the city on index 2
     """
-    ipinfo_api_uri = "https://ipinfo.io/json"  # gets ipinfo for current ip
-    response = requests.get(ipinfo_api_uri)
-    response.raise_for_status()
+    ipinfo_api_uri = os.environ.get("RAINY_IPINFO_URI", "https://ipinfo.io/json")  # gets ipinfo for current ip
+    response = http_get(ipinfo_api_uri, endpoint="ipinfo")
 
     data = response.json()
     if not data:
@@ -71,8 +800,237 @@ def get_location_by_ip() -> tuple[float, float, str]:
     return latitude, longitude, city
 
 
+def get_network_fingerprint() -> str:
+    """
+    Gets a cheap fingerprint of the network the machine is currently connected to, without sending any packets.
+    It consists of the local address the default route uses and, on Linux, the default gateway.
+    If the machine moves to another network, the fingerprint changes, which means the location by IP has to be looked up again.
+
+    :return: A string identifying the current network. It is empty if the machine has no default route.
+    """
+    import socket
+
+    parts = []
+    try:
+        # connecting a UDP socket only selects the route, it doesn't send anything
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect(("8.8.8.8", 53))
+            parts.append(sock.getsockname()[0])
+    except OSError:
+        pass
+
+    try:
+        with open("/proc/net/route", encoding="ascii") as file:
+            for line in file.readlines()[1:]:
+                fields = line.split()
+                if len(fields) > 2 and fields[1] == "00000000":
+                    parts.append(f"{fields[0]}/{fields[2]}")
+                    break
+    except OSError:
+        pass
+
+    return ",".join(parts)
+
+
+def get_cached_location_by_ip(ttl: int) -> tuple[float, float, str]:
+    """
+    Gets the location like get_location_by_ip, but reuses the last result as long as the network fingerprint didn't change and it is younger than ttl seconds.
+
+    :param ttl: The maximum time in seconds the location is reused for. If 0 or less, the cache is bypassed.
+    :type ttl: int
+    :returns: tuple: The same tuple get_location_by_ip returns.
+    """
+    if ttl <= 0:
+        return get_location_by_ip()
+
+    fingerprint = get_network_fingerprint()
+    entry = read_cache("location_ip", ttl)
+    if entry is not None and fingerprint and entry["data"].get("fingerprint") == fingerprint:
+        return tuple(entry["data"]["location"])
+
+    with cache_lock("location_ip"):
+        # another rainy process may have looked it up while this one was waiting for the lock
+        entry = read_cache("location_ip", ttl)
+        if entry is not None and fingerprint and entry["data"].get("fingerprint") == fingerprint:
+            return tuple(entry["data"]["location"])
+
+        try:
+            location = get_location_by_ip()
+        except FetchError:
+            # fall back to the last known location, no matter which network it was looked up in
+            entry = read_cache("location_ip", None)
+            if entry is None:
+                raise
+            return tuple(entry["data"]["location"])
+        write_cache("location_ip", {"fingerprint": fingerprint, "location": list(location)})
+    return location
+
+
+# layout of the offline geocoding index: a header followed by fixed-width records sorted by key
+GEOINDEX_MAGIC = b"RNYG"
+GEOINDEX_HEADER = "<4sHHI"  # magic, version, record size, records
+GEOINDEX_RECORD = "<48s48s2sffI"  # case-folded name, name, country code, latitude, longitude, population
+GEOINDEX_KEY_SIZE = 48
+
+# the opened offline geocoding index, see get_geoindex
+_geoindex = None
+
+
+def get_geoindex_path() -> str:
+    return os.path.join(get_cache_dir(), "geoindex.bin")
+
+
+def build_geoindex(dump_path: str, index_path: str) -> int:
+    """
+    Builds the offline geocoding index from a GeoNames cities dump, like cities500.txt or cities500.zip from https://download.geonames.org/export/dump/.
+    Every place is indexed by its name and, if it differs, by its ASCII name. Names longer than GEOINDEX_KEY_SIZE bytes are left out.
+
+    :param dump_path: The path of the tab-separated dump, or of a zip archive containing it.
+    :type dump_path: str
+    :param index_path: The path to write the index to.
+    :type index_path: str
+    :return: The number of records in the index.
+    :raises OSError: If the dump can't be read or the index can't be written.
+    """
+    import io
+    import struct
+    import zipfile
+
+    if zipfile.is_zipfile(dump_path):
+        with zipfile.ZipFile(dump_path) as archive:
+            member = next(name for name in archive.namelist() if name.endswith(".txt"))
+            lines = io.TextIOWrapper(archive.open(member), encoding="utf-8").readlines()
+    else:
+        with open(dump_path, encoding="utf-8") as file:
+            lines = file.readlines()
+
+    records = []
+    for line in lines:
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) < 15:
+            continue
+        name, ascii_name, latitude, longitude, country_code = fields[1], fields[2], float(fields[4]), float(fields[5]), fields[8].upper()
+        population = int(fields[14] or 0)
+        encoded_name = name.encode("utf-8")[:GEOINDEX_KEY_SIZE]
+        for key in dict.fromkeys((name.casefold(), ascii_name.casefold())):
+            encoded_key = key.encode("utf-8")
+            if key and len(encoded_key) <= GEOINDEX_KEY_SIZE:
+                records.append((encoded_key, encoded_name, country_code.encode("ascii", "replace")[:2], latitude, longitude, min(population, 2**32 - 1)))
+
+    # the most populous place comes first among places with the same name, like the API ranks them
+    records.sort(key=lambda record: (record[0], -record[5]))
+    record = struct.Struct(GEOINDEX_RECORD)
+    data = struct.pack(GEOINDEX_HEADER, GEOINDEX_MAGIC, 1, record.size, len(records)) + b"".join(record.pack(*fields) for fields in records)
+    write_file_atomically(index_path, data)
+    return len(records)
+
+
+class GeoIndex:
+    """
+    The offline geocoding index built by build_geoindex, memory-mapped so lookups only read the few records a binary search visits.
+
+    :param path: The path of the index.
+    :raises OSError: If the index can't be opened.
+    :raises ValueError: If the file isn't a valid index.
+    """
+
+    def __init__(self, path: str) -> None:
+        import mmap
+        import struct
+
+        with open(path, "rb") as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header_size = struct.calcsize(GEOINDEX_HEADER)
+        self.record = struct.Struct(GEOINDEX_RECORD)
+        try:
+            magic, version, record_size, self.count = struct.unpack_from(GEOINDEX_HEADER, self.data)
+        except struct.error as error:
+            raise ValueError("The geocoding index is truncated.") from error
+        if magic != GEOINDEX_MAGIC or version != 1 or record_size != self.record.size or self.header_size + self.count * record_size > len(self.data):
+            raise ValueError("The geocoding index has an unknown format.")
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index: int) -> bytes:
+        # the key of the record, so bisect can search the index directly
+        offset = self.header_size + index * self.record.size
+        return self.data[offset:offset + GEOINDEX_KEY_SIZE]
+
+    def lookup(self, city_name: str, country_code: str | None = None, prefix: bool = False) -> tuple[float, float, str] | None:
+        """
+        Looks up the passed city name. A place with exactly the passed name is preferred over one whose name only matches case-insensitively.
+        Within each, the most populous place wins.
+
+        :param city_name: The name of the city to look up.
+        :type city_name: str
+        :param country_code: The ISO 3166-1 alpha-2 code of the country to look in, or None to search all countries.
+        :type country_code: str
+        :param prefix: Whether to fall back to the most populous place whose name merely starts with the passed name, which may well be another place.
+        :type prefix: bool
+        :returns: tuple: The same tuple get_location_by_city_name returns, or None if the city isn't in the index.
+        """
+        import bisect
+
+        key = city_name.strip().casefold().encode("utf-8")
+        if not key or len(key) > GEOINDEX_KEY_SIZE:
+            return None
+        country = (country_code or "").upper().encode("ascii", "replace")
+
+        padded_key = key.ljust(GEOINDEX_KEY_SIZE, b"\0")
+        start = bisect.bisect_left(self, padded_key)
+        end = bisect.bisect_right(self, padded_key, start)
+        matches = [fields for fields in self.read(start, end) if not country or fields[2] == country]
+        if not matches and prefix:
+            # UTF-8 never contains 0xff, so every key starting with the passed name sorts before this one
+            end = bisect.bisect_left(self, (key + b"\xff").ljust(GEOINDEX_KEY_SIZE, b"\0"), end)
+            matches = sorted((fields for fields in self.read(start, min(end, start + 1000)) if not country or fields[2] == country), key=lambda fields: -fields[5])
+        if not matches:
+            return None
+
+        name = city_name.strip().encode("utf-8")
+        _, found_name, _, latitude, longitude, _ = next((fields for fields in matches if fields[1].rstrip(b"\0") == name), matches[0])
+        return round(latitude, 2), round(longitude, 2), found_name.rstrip(b"\0").decode("utf-8", "ignore")
+
+    def read(self, start: int, end: int) -> list[tuple]:
+        return [self.record.unpack_from(self.data, self.header_size + index * self.record.size) for index in range(start, end)]
+
+
+def get_geoindex() -> GeoIndex | None:
+    """
+    Opens the offline geocoding index the first time it is needed.
+
+    :return: The index, or None if it hasn't been built or can't be read.
+    """
+    global _geoindex
+    if _geoindex is None:
+        try:
+            _geoindex = GeoIndex(get_geoindex_path())
+        except (OSError, ValueError):
+            _geoindex = False
+    return _geoindex or None
+
+
+def find_in_geoindex(city_name: str, country_code: str | None = None, prefix: bool = False) -> tuple[float, float, str] | None:
+    """
+    Looks up the passed city name in the offline geocoding index, if it has been built. See GeoIndex.lookup.
+
+    :returns: tuple: The same tuple get_location_by_city_name returns, or None if the city isn't in the index.
+    """
+    geoindex = get_geoindex()
+    if geoindex is None:
+        return None
+    location = geoindex.lookup(city_name, country_code, prefix)
+    trace.record("cache", name="geoindex", hit=location is not None)
+    return location
+
+
 def get_location_by_city_name(city_name: str, country_code: str | None = None) -> tuple[float, float, str]:
-    geocoding_api_uri: str = "https://geocoding-api.open-meteo.com/v1/search"
+    location = find_in_geoindex(city_name, country_code)
+    if location is not None:
+        return location
+
+    geocoding_api_uri: str = os.environ.get("RAINY_GEOCODING_URI", "https://geocoding-api.open-meteo.com/v1/search")
     params = {
         "name": city_name,
         "count": 1,
@@ -83,8 +1041,7 @@ def get_location_by_city_name(city_name: str, country_code: str | None = None) -
     if country_code:
         params["countryCode"] = country_code
 
-    response = requests.get(geocoding_api_uri, params=params)
-    response.raise_for_status()
+    response = http_get(geocoding_api_uri, params=params, endpoint="geocoding")
 
     data = response.json()
     results = data.get("results")
@@ -99,98 +1056,846 @@ def get_location_by_city_name(city_name: str, country_code: str | None = None) -
     return latitude, longitude, results[0]["name"]
 
 
-def get_weather(latitude: float, longitude: float, wind_speed_unit: str, temperature_unit: str) -> tuple[int, str, str, float, float, float, float, float, int, bool]:
-    """Gets the latest weather data for the passed latitude and longitude using api.open-meteo.com.
-    The API only takes latitude and longitude with 2 decimal places.
+def get_cached_location_by_city_name(city_name: str, country_code: str | None, ttl: int) -> tuple[float, float, str]:
+    """
+    Gets the location like get_location_by_city_name, but serves it from the on-disk cache if it has been looked up less than ttl seconds ago.
+    Entries are keyed by the case-folded city name and the country code.
+    If the API can't be reached, the last cached location is used, or else the most populous place in the offline index whose name starts with the passed name.
+
+    :param city_name: The name of the city to look up.
+    :type city_name: str
+    :param country_code: The ISO 3166-1 alpha-2 code of the country to look in, or None to search all countries.
+    :type country_code: str
+    :param ttl: The time in seconds a cached location is used for. If 0 or less, the cache is bypassed.
+    :type ttl: int
+    :returns: tuple: The same tuple get_location_by_city_name returns.
+    """
+    if ttl <= 0:
+        try:
+            return get_location_by_city_name(city_name, country_code)
+        except FetchError:
+            location = find_in_geoindex(city_name, country_code, prefix=True)
+            if location is None:
+                raise
+            return location
+
+    # the offline index is faster than the cache
+    location = find_in_geoindex(city_name, country_code)
+    if location is not None:
+        return location
+
+    import hashlib
+
+    key = f"{city_name.strip().casefold()}|{(country_code or '').upper()}"
+    cache_name = "city_" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    entry = read_cache(cache_name, ttl)
+    if entry is not None:
+        return tuple(entry["data"])
+
+    with cache_lock(cache_name):
+        entry = read_cache(cache_name, ttl)
+        if entry is not None:
+            return tuple(entry["data"])
+
+        try:
+            location = get_location_by_city_name(city_name, country_code)
+        except FetchError:
+            entry = read_cache(cache_name, None)
+            if entry is not None:
+                return tuple(entry["data"])
+            # a place whose name merely starts with the passed one is better than none, but only if the API can't tell
+            location = find_in_geoindex(city_name, country_code, prefix=True)
+            if location is None:
+                raise
+            return location
+        write_cache(cache_name, list(location))
+    return location
+
+
+# the units forecasts are fetched and cached in, whatever units are shown, see convert_units
+API_WIND_SPEED_UNIT = "kmh"
+API_TEMPERATURE_UNIT = "celsius"
+
+# the variables of the tuple returned by get_weather, in its order, each with the block of the API response it is in
+WEATHER_VARIABLES = (
+    ("current", "weather_code"),
+    ("daily", "sunrise"),
+    ("daily", "sunset"),
+    ("current", "temperature_2m"),
+    ("daily", "temperature_2m_max"),
+    ("daily", "temperature_2m_min"),
+    ("current", "apparent_temperature"),
+    ("current", "wind_speed_10m"),
+    ("current", "wind_direction_10m"),
+    ("current", "is_day"),
+)
+WEATHER_FIELDS = tuple(name for _, name in WEATHER_VARIABLES)
+
+# the variables recorded in the history, see append_history, which are requested whatever is shown
+HISTORY_VARIABLES = ("weather_code", "temperature_2m", "apparent_temperature", "wind_speed_10m", "wind_direction_10m")
+
+# the variables needed by each setting of the Show and Output sections, see get_weather_fields
+SHOW_VARIABLES = {
+    "show_weather": ("weather_code",),
+    "show_temperature": ("temperature_2m",),
+    "show_wind_speed": ("wind_speed_10m",),
+    "show_wind_direction": ("wind_direction_10m",),
+    "show_sunrise": ("sunrise",),
+    "show_sunset": ("sunset",),
+    "show_ascii_art": ("weather_code", "is_day"),
+}
+
+# the variables needed by each field of --format templates
+FORMAT_VARIABLES = {
+    "weather": ("weather_code",),
+    "emoji": ("weather_code",),
+    "temperature": ("temperature_2m",),
+    "temperature_max": ("temperature_2m_max",),
+    "temperature_min": ("temperature_2m_min",),
+    "apparent_temperature": ("apparent_temperature",),
+    "wind_speed": ("wind_speed_10m",),
+    "wind_direction": ("wind_direction_10m",),
+    "sunrise": ("sunrise",),
+    "sunset": ("sunset",),
+}
+
+
+def get_weather_fields(config, args=None) -> tuple[str, ...]:
+    """
+    Gets the forecast variables the output requested by the passed CLI arguments shows, so only these are requested from the API.
+    The usual output and tables need the ones enabled in the Show section of the configuration, --format templates the ones of their fields and --json all of them.
+    The variables recorded in the history, HISTORY_VARIABLES, are always included.
+
+    :param config: The configuration returned by load_config.
+    :type config: dict
+    :param args: The parsed CLI arguments. If None, the usual output is assumed.
+    :return: The names of the variables, in the order of WEATHER_FIELDS.
+    """
+    if args is not None and args.json:
+        return WEATHER_FIELDS
+    if args is not None and args.format is not None:
+        import string
+
+        needed = {variable for _, field, _, _ in string.Formatter().parse(args.format) if field for variable in FORMAT_VARIABLES.get(field, ())}
+    else:
+        needed = {variable for key, variables in SHOW_VARIABLES.items() if config.get(key) for variable in variables}
+        # both are shown as part of the temperature
+        if config.get("show_temperature") and config.get("show_apparent_temperature"):
+            needed.add("apparent_temperature")
+        if config.get("show_temperature") and config.get("show_max_and_min_temperature"):
+            needed.update(("temperature_2m_max", "temperature_2m_min"))
+    needed.update(HISTORY_VARIABLES)
+    return tuple(field for field in WEATHER_FIELDS if field in needed)
+
+
+def get_weather(latitude: float, longitude: float, fields: tuple[str, ...] = WEATHER_FIELDS) -> tuple[int, str, str, float, float, float, float, float, int, bool]:
+    """Gets the latest weather data for the passed latitude and longitude using api.open-meteo.com.
+    The API only takes latitude and longitude with 2 decimal places.
+    Temperatures are in Celsius and the wind speed is in km/h, see convert_units.
+
+    :param latitude: The latitude rounded to 2 decimal places.
+    :type latitude: float
+    :param longitude: The longitude rounded to 2 decimal places.
+    :type longitude: float
+    :param fields: The variables to request, see get_weather_fields. The others are None in the returned tuple.
+    :type fields: tuple
+
+    :returns: tuple: It contains the weather_code (a WMO Weather interpretation (WW) code that describes the current weather (1-99) (https://open-meteo.com/en/docs))
+    """
+    return get_weather_batch([(latitude, longitude)], fields)[0]
+
+
+def get_weather_batch(locations: list[tuple[float, float]], fields: tuple[str, ...] = WEATHER_FIELDS) -> list[tuple[int, str, str, float, float, float, float, float, int, bool]]:
+    """Gets the latest weather data for all passed locations with a single call to api.open-meteo.com.
+    The API takes comma-separated lists of latitudes and longitudes and answers with one forecast per location.
+
+    :param locations: The latitudes and longitudes rounded to 2 decimal places.
+    :type locations: list
+    :param fields: The variables to request, see get_weather_fields. The others are None in the returned tuples.
+    :type fields: tuple
+
+    :returns: list: The tuples get_weather returns, in the same order as the passed locations.
+    """
+    return parse_weather_response(request_weather(locations, fields), locations, fields)
+
+
+def request_weather(locations: list[tuple[float, float]], fields: tuple[str, ...], validators: dict | None = None) -> requests.Response:
+    """Sends the request for the passed variables of the forecast of the passed locations to api.open-meteo.com.
+    If the validators of an earlier response for the same request are passed, the request is conditional: If the forecast didn't change, the API answers with '304 Not Modified' and an empty body.
+
+    :param locations: The latitudes and longitudes rounded to 2 decimal places.
+    :type locations: list
+    :param fields: The variables to request.
+    :type fields: tuple
+    :param validators: The 'etag' and 'last_modified' of the earlier response, see get_validators.
+    :type validators: dict
+    :return: The response.
+    """
+    forecast_api_uri = os.environ.get("RAINY_FORECAST_URI", "https://api.open-meteo.com/v1/forecast")
+    params = {
+        "latitude": ",".join(str(latitude) for latitude, _ in locations),
+        "longitude": ",".join(str(longitude) for _, longitude in locations),
+    }
+    for block in ("daily", "current"):
+        names = [name for variable_block, name in WEATHER_VARIABLES if variable_block == block and name in fields]
+        if names:
+            params[block] = ",".join(names)
+    params.update({
+        "timezone": "auto",
+        "forecast_days": 1,
+        "wind_speed_unit": API_WIND_SPEED_UNIT,
+        "temperature_unit": API_TEMPERATURE_UNIT
+    })
+
+    headers = {}
+    if validators is not None and validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators is not None and validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return http_get(forecast_api_uri, params=params, endpoint="forecast", headers=headers)
+
+
+def parse_weather_response(response: requests.Response, locations: list[tuple[float, float]], fields: tuple[str, ...]) -> list[tuple[int, str, str, float, float, float, float, float, int, bool]]:
+    """Parses the response to request_weather.
+
+    :returns: list: The tuples get_weather returns, in the same order as the passed locations.
+    """
+    data = response.json()
+    # a single location is answered with an object instead of a list
+    if isinstance(data, dict):
+        data = [data]
+    if len(data) != len(locations):
+        raise ValueError(f"Expected {len(locations)} forecasts, but got {len(data)}.")
+    return [parse_weather(location_data, fields) for location_data in data]
+
+
+def parse_weather(data: dict, fields: tuple[str, ...] = WEATHER_FIELDS) -> tuple[int, str, str, float, float, float, float, float, int, bool]:
+    """Extracts the values rainy needs from the forecast of a single location returned by api.open-meteo.com.
+
+    :param data: The forecast of a single location as returned by the API.
+    :type data: dict
+    :param fields: The variables that were requested. The others are None in the returned tuple.
+    :type fields: tuple
+
+    :returns: tuple: The same tuple get_weather returns.
+    """
+    current = data.get("current", {})
+    daily = data.get("daily", {})
+    weather_code: int | None = int(current["weather_code"]) if "weather_code" in fields else None
+    sunrise: str | None = "".join(daily["sunrise"])[-5:] if "sunrise" in fields else None
+    sunset: str | None = "".join(daily["sunset"])[-5:] if "sunset" in fields else None
+    temperature: float | None = float(current["temperature_2m"]) if "temperature_2m" in fields else None
+    temperature_max: float | None = float(daily["temperature_2m_max"][0]) if "temperature_2m_max" in fields else None
+    temperature_min: float | None = float(daily["temperature_2m_min"][0]) if "temperature_2m_min" in fields else None
+    apparent_temperature: float | None = float(current["apparent_temperature"]) if "apparent_temperature" in fields else None
+    wind_speed: float | None = float(current["wind_speed_10m"]) if "wind_speed_10m" in fields else None
+    wind_direction: int | None = int(current["wind_direction_10m"]) if "wind_direction_10m" in fields else None
+    is_day: bool | None = bool(current["is_day"]) if "is_day" in fields else None
+    return weather_code, sunrise, sunset, temperature, temperature_max, temperature_min, apparent_temperature, wind_speed, wind_direction, is_day
+
+
+def get_validators(response: requests.Response) -> dict:
+    """
+    Gets what the cache entry of a forecast needs to know about the response it was fetched with:
+    its validators for conditional requests and, from its Cache-Control header, how long the API allows reusing it without asking again.
+
+    :param response: The response to request_weather.
+    :return: The 'etag' and 'last_modified' of the response, either None if not sent, and 'expires_at', a Unix timestamp that is 0 if the API didn't allow reuse.
+    """
+    directives = {}
+    for directive in response.headers.get("Cache-Control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        directives[name.lower()] = value.strip('"')
+    if "no-store" in directives:
+        return {"etag": None, "last_modified": None, "expires_at": 0}
+
+    expires_at = 0
+    if "max-age" in directives and "no-cache" not in directives:
+        try:
+            expires_at = time.time() + int(directives["max-age"]) - int(response.headers.get("Age", 0))
+        except ValueError:
+            pass
+    return {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified"), "expires_at": expires_at}
+
+
+def get_weather_cache_name(latitude: float, longitude: float) -> str:
+    """
+    Gets the name of the cache entry for the forecast of the passed location.
+    Forecasts are cached in the units they are fetched in, so the entry is shared by all configured units.
+
+    :return: The name of the cache entry.
+    """
+    return f"weather_{latitude:.2f}_{longitude:.2f}"
+
+
+def read_weather_cache(name: str) -> dict | None:
+    """
+    Reads the cache entry of a forecast written by write_weather_cache, regardless of its age.
+
+    :param name: The name of the cache entry, see get_weather_cache_name.
+    :type name: str
+    :return: The 'weather', the 'fields' it contains, the time it was 'fetched_at' and the validators returned by get_validators, or None if there is no entry.
+    """
+    entry = read_cache(name, None)
+    if entry is None:
+        return None
+    data = entry["data"]
+    if isinstance(data, list):
+        # written before the fields were recorded, when all of them were fetched
+        data = {"fields": list(WEATHER_FIELDS), "weather": data}
+    return {"etag": None, "last_modified": None, "expires_at": 0, **data, "fetched_at": entry.get("fetched_at", 0)}
+
+
+def write_weather_cache(name: str, weather: tuple, fields: tuple[str, ...], validators: dict | None = None) -> None:
+    """
+    Writes the passed forecast to the cache entry with the passed name, together with the fields it contains and the validators of the response it was fetched with.
+    """
+    write_cache(name, {"fields": list(fields), "weather": list(weather), **(validators or {})})
+
+
+def is_weather_usable(entry: dict | None, ttl: float, fields: tuple[str, ...], fetched_after: float = 0) -> bool:
+    """
+    Checks if the passed cache entry contains the passed fields, was fetched after the passed time and is either younger than ttl seconds or still allowed to be reused by the API.
+    """
+    if entry is None or not set(fields) <= set(entry["fields"]) or entry["fetched_at"] < fetched_after:
+        return False
+    now = time.time()
+    return now - entry["fetched_at"] < ttl or now < entry["expires_at"]
+
+
+def get_cached_weather(latitude: float, longitude: float, ttl: int, fields: tuple[str, ...] = WEATHER_FIELDS, fetched_after: float = 0) -> tuple[int, str, str, float, float, float, float, float, int, bool]:
+    """Gets the weather like get_weather, but serves it from the on-disk cache if it has been fetched less than ttl seconds ago, or the API allowed reusing it for longer.
+    Entries are keyed by the rounded latitude and longitude and record the fields they contain. An entry missing some of the passed fields is fetched again,
+    together with the fields it has, so entries never lose fields other callers need.
+    Once an entry expired, it is revalidated with a conditional request for all of its fields, which only transfers the forecast again if it changed.
+
+    :param latitude: The latitude rounded to 2 decimal places.
+    :type latitude: float
+    :param longitude: The longitude rounded to 2 decimal places.
+    :type longitude: float
+    :param ttl: The time in seconds a cached forecast is used for. If 0 or less, the cache is bypassed.
+    :type ttl: int
+    :param fields: The variables needed, see get_weather_fields.
+    :type fields: tuple
+    :param fetched_after: An entry fetched before this time (a Unix timestamp) is revalidated, however long it could be used otherwise.
+    :type fetched_after: float
+
+    :returns: tuple: The same tuple get_weather returns.
+    """
+    if ttl <= 0:
+        weather = get_weather(latitude, longitude, fields)
+        append_history(latitude, longitude, weather, time.time())
+        return weather
+
+    cache_name = get_weather_cache_name(latitude, longitude)
+    entry = read_weather_cache(cache_name)
+    if is_weather_usable(entry, ttl, fields, fetched_after):
+        return tuple(entry["weather"])
+
+    with cache_lock(cache_name):
+        entry = read_weather_cache(cache_name)
+        if is_weather_usable(entry, ttl, fields, fetched_after):
+            return tuple(entry["weather"])
+
+        validators = None
+        if entry is not None:
+            # keep the fields it has for whoever needs them
+            fields = tuple(field for field in WEATHER_FIELDS if field in fields or field in entry["fields"])
+            if set(fields) == set(entry["fields"]):
+                validators = entry
+
+        try:
+            response = request_weather([(latitude, longitude)], fields, validators)
+            if response.status_code == 304:
+                # unchanged since it was fetched, so it is reused without transferring it again
+                validators = {**get_validators(response), "etag": response.headers.get("ETag") or entry["etag"], "last_modified": response.headers.get("Last-Modified") or entry["last_modified"]}
+                write_weather_cache(cache_name, entry["weather"], fields, validators)
+                return tuple(entry["weather"])
+            weather = parse_weather_response(response, [(latitude, longitude)], fields)[0]
+        except FetchError:
+            # serve the last forecast fetched, even if it is outdated
+            if entry is None or not set(fields) <= set(entry["fields"]):
+                raise
+            return tuple(entry["weather"])
+        write_weather_cache(cache_name, weather, fields, get_validators(response))
+        append_history(latitude, longitude, weather, time.time())
+    return weather
+
+
+def get_cached_weather_batch(locations: list[tuple[float, float]], ttl: int, fields: tuple[str, ...] = WEATHER_FIELDS) -> list[tuple[int, str, str, float, float, float, float, float, int, bool]]:
+    """Gets the weather for all passed locations like get_weather_batch, but only fetches the locations that aren't cached yet.
+    Uses the same cache entries as get_cached_weather. A single missing location is fetched by get_cached_weather, which revalidates its entry.
+    The validators of a response for multiple locations don't apply to the single locations, so they aren't kept.
+
+    :param locations: The latitudes and longitudes rounded to 2 decimal places.
+    :type locations: list
+    :param ttl: The time in seconds a cached forecast is used for. If 0 or less, the cache is bypassed.
+    :type ttl: int
+    :param fields: The variables needed, see get_weather_fields.
+    :type fields: tuple
+
+    :returns: list: The tuples get_weather returns, in the same order as the passed locations.
+    """
+    cache_names = [get_weather_cache_name(latitude, longitude) for latitude, longitude in locations]
+    forecasts = {}
+    entry_fields = set()
+    if ttl > 0:
+        for location, cache_name in zip(locations, cache_names):
+            entry = read_weather_cache(cache_name)
+            if is_weather_usable(entry, ttl, fields):
+                forecasts[location] = tuple(entry["weather"])
+            elif entry is not None:
+                entry_fields.update(entry["fields"])
+
+    # the same location may be passed more than once
+    missing = list(dict.fromkeys(location for location in locations if location not in forecasts))
+    if len(missing) == 1 and ttl > 0:
+        forecasts[missing[0]] = get_cached_weather(*missing[0], ttl, fields)
+    elif missing:
+        # the entries written keep the fields the ones they replace had
+        fields = tuple(field for field in WEATHER_FIELDS if field in fields or field in entry_fields)
+        try:
+            fetched = get_weather_batch(missing, fields)
+        except FetchError:
+            for location, cache_name in zip(locations, cache_names):
+                if location not in forecasts:
+                    entry = read_weather_cache(cache_name)
+                    if entry is None or not set(fields) <= set(entry["fields"]):
+                        raise
+                    forecasts[location] = tuple(entry["weather"])
+        else:
+            for location, weather in zip(missing, fetched):
+                forecasts[location] = weather
+                append_history(*location, weather, time.time())
+                if ttl > 0:
+                    write_weather_cache(get_weather_cache_name(*location), weather, fields)
+
+    return [forecasts[location] for location in locations]
+
+
+# layout of the hourly forecast store: a header followed by one array per series
+HOURLY_STORE_MAGIC = b"RNYH"
+HOURLY_STORE_HEADER = "<4sHdqiiii"  # magic, version, fetched_at, start, step, hours, days, utc_offset
+HOURLY_SERIES = (("temperature_2m", "f"), ("apparent_temperature", "f"), ("wind_speed_10m", "f"), ("wind_direction_10m", "H"), ("weather_code", "B"), ("is_day", "B"))
+DAILY_SERIES = (("time", "q"), ("sunrise", "q"), ("sunset", "q"), ("temperature_2m_max", "f"), ("temperature_2m_min", "f"))
+
+
+def get_hourly_weather(latitude: float, longitude: float, forecast_days: int) -> dict:
+    """Gets the hourly forecast for the next forecast_days days for the passed latitude and longitude using api.open-meteo.com.
+    Together with the daily sunrise, sunset, maximum and minimum temperature, it is enough to show the current weather at any time during these days without asking the API again.
+
+    :param latitude: The latitude rounded to 2 decimal places.
+    :type latitude: float
+    :param longitude: The longitude rounded to 2 decimal places.
+    :type longitude: float
+    :param forecast_days: The number of days to get the forecast for (1-16).
+    :type forecast_days: int
+
+    :returns: dict: The forecast in the format of the hourly store, see pack_hourly_store.
+    """
+    import array
+
+    forecast_api_uri = os.environ.get("RAINY_FORECAST_URI", "https://api.open-meteo.com/v1/forecast")
+    params = {
+        "latitude": latitude,
+        "longitude": longitude,
+        "hourly": ",".join(name for name, _ in HOURLY_SERIES),
+        "daily": ",".join(name for name, _ in DAILY_SERIES[1:]),
+        "timezone": "auto",
+        "timeformat": "unixtime",
+        "forecast_days": max(1, min(16, forecast_days)),
+        "wind_speed_unit": API_WIND_SPEED_UNIT,
+        "temperature_unit": API_TEMPERATURE_UNIT
+    }
+    response = http_get(forecast_api_uri, params=params, endpoint="forecast")
+
+    data = response.json()
+    hourly_time = data["hourly"]["time"]
+    if len(hourly_time) < 2 or not data["daily"]["time"]:
+        raise FetchError(f"The API returned an empty forecast for url: {response.url}")
+
+    # missing values are stored as NaN or 0, depending on the type of the series
+    return {
+        "fetched_at": time.time(),
+        "start": int(hourly_time[0]),
+        "step": int(hourly_time[1]) - int(hourly_time[0]),
+        "utc_offset": int(data.get("utc_offset_seconds", 0)),
+        "hourly": {name: array.array(typecode, [(float("nan") if typecode == "f" else 0) if value is None else value for value in data["hourly"][name]]) for name, typecode in HOURLY_SERIES},
+        "daily": {name: array.array(typecode, [(float("nan") if typecode == "f" else 0) if value is None else value for value in data["daily"][name]]) for name, typecode in DAILY_SERIES},
+    }
+
+
+def pack_hourly_store(store: dict) -> bytes:
+    """
+    Packs the passed hourly forecast into the compact binary format it is cached in.
+    It consists of a little-endian header followed by the raw little-endian items of every hourly and daily series, in the order of HOURLY_SERIES and DAILY_SERIES.
+
+    :param store: The forecast as returned by get_hourly_weather.
+    :type store: dict
+    :return: The packed forecast.
+    """
+    import struct
+
+    series = [store["hourly"][name] for name, _ in HOURLY_SERIES] + [store["daily"][name] for name, _ in DAILY_SERIES]
+    hours = len(series[0])
+    days = len(store["daily"]["time"])
+    header = struct.pack(HOURLY_STORE_HEADER, HOURLY_STORE_MAGIC, 1, store["fetched_at"], store["start"], store["step"], hours, days, store["utc_offset"])
+
+    chunks = [header]
+    for values in series:
+        if sys.byteorder == "big":
+            values = values[:]
+            values.byteswap()
+        chunks.append(values.tobytes())
+    return b"".join(chunks)
+
+
+def unpack_hourly_store(data: bytes) -> dict:
+    """
+    Unpacks an hourly forecast packed by pack_hourly_store.
+
+    :param data: The packed forecast.
+    :type data: bytes
+    :return: The forecast in the format returned by get_hourly_weather.
+    :raises ValueError: If the data isn't a valid hourly forecast.
+    """
+    import array
+    import struct
+
+    header_size = struct.calcsize(HOURLY_STORE_HEADER)
+    try:
+        magic, version, fetched_at, start, step, hours, days, utc_offset = struct.unpack_from(HOURLY_STORE_HEADER, data)
+    except struct.error as error:
+        raise ValueError("The hourly forecast is truncated.") from error
+    if magic != HOURLY_STORE_MAGIC or version != 1 or step <= 0:
+        raise ValueError("The hourly forecast has an unknown format.")
+
+    store = {"fetched_at": fetched_at, "start": start, "step": step, "utc_offset": utc_offset, "hourly": {}, "daily": {}}
+    offset = header_size
+    for group, count, series in (("hourly", hours, HOURLY_SERIES), ("daily", days, DAILY_SERIES)):
+        for name, typecode in series:
+            values = array.array(typecode)
+            size = values.itemsize * count
+            if offset + size > len(data):
+                raise ValueError("The hourly forecast is truncated.")
+            values.frombytes(data[offset:offset + size])
+            if sys.byteorder == "big":
+                values.byteswap()
+            store[group][name] = values
+            offset += size
+    return store
+
+
+def select_current_weather(store: dict, now: float) -> tuple[int, str, str, float, float, float, float, float, int, bool] | None:
+    """
+    Selects the weather at the passed time from the passed hourly forecast.
+    Temperatures and the wind speed are interpolated linearly between the surrounding hours, everything else is taken from the nearest hour.
+
+    :param store: The forecast as returned by get_hourly_weather.
+    :type store: dict
+    :param now: The time to get the weather for as a Unix timestamp.
+    :type now: float
+    :returns: tuple: The same tuple get_weather returns, or None if the forecast doesn't cover the passed time.
+    """
+    import bisect
+
+    hourly = store["hourly"]
+    hours = len(hourly["temperature_2m"])
+    position = (now - store["start"]) / store["step"]
+    hour = int(position)
+    if position < 0 or hour >= hours:
+        return None
+    next_hour = min(hour + 1, hours - 1)
+    fraction = position - hour
+    nearest = next_hour if fraction >= 0.5 else hour
+
+    # the days start at local midnight, so today is the last day that started before now, even if it has 23 or 25 hours because daylight saving time starts or ends
+    daily = store["daily"]
+    day = bisect.bisect_right(daily["time"], now) - 1
+    if day < 0:
+        return None
+
+    def interpolate(name: str) -> float:
+        return round(hourly[name][hour] + (hourly[name][next_hour] - hourly[name][hour]) * fraction, 1)
+
+    # utc_offset is only the offset when the forecast was fetched. As every day starts at local midnight, the offset of a day is the one closest to it that makes its start midnight.
+    # Daylight saving time starts and ends before sunrise, so the start of the next day is used, if there is one.
+    day_start = daily["time"][min(day + 1, len(daily["time"]) - 1)]
+    utc_offset = store["utc_offset"] + (-day_start - store["utc_offset"] + 43200) % 86400 - 43200
+
+    def local_time(timestamp: int) -> str:
+        return time.strftime("%H:%M", time.gmtime(timestamp + utc_offset))
+
+    return (
+        int(hourly["weather_code"][nearest]),
+        local_time(daily["sunrise"][day]),
+        local_time(daily["sunset"][day]),
+        interpolate("temperature_2m"),
+        round(daily["temperature_2m_max"][day], 1),
+        round(daily["temperature_2m_min"][day], 1),
+        interpolate("apparent_temperature"),
+        interpolate("wind_speed_10m"),
+        int(hourly["wind_direction_10m"][nearest]),
+        bool(hourly["is_day"][nearest]),
+    )
+
+
+def get_cached_hourly_weather(latitude: float, longitude: float, forecast_days: int, refresh_after: int) -> tuple[int, str, str, float, float, float, float, float, int, bool]:
+    """Gets the current weather from a cached multi-day hourly forecast, which is downloaded again only once it is older than refresh_after seconds or doesn't cover the current time anymore.
+    The current weather is recorded in the history whenever the forecast is downloaded.
+
+    :param latitude: The latitude rounded to 2 decimal places.
+    :type latitude: float
+    :param longitude: The longitude rounded to 2 decimal places.
+    :type longitude: float
+    :param forecast_days: The number of days to download the forecast for.
+    :type forecast_days: int
+    :param refresh_after: The time in seconds after which the forecast is downloaded again.
+    :type refresh_after: int
+
+    :returns: tuple: The same tuple get_weather returns.
+    """
+    path = os.path.join(get_cache_dir(), f"hourly_{latitude:.2f}_{longitude:.2f}.bin")
+
+    def read_store() -> dict | None:
+        try:
+            with open(path, "rb") as file:
+                store = unpack_hourly_store(file.read())
+        except (OSError, ValueError):
+            store = None
+        trace.record("cache", name=os.path.basename(path), hit=store is not None)
+        return store
+
+    store = read_store()
+    if store is not None and time.time() - store["fetched_at"] <= refresh_after:
+        weather = select_current_weather(store, time.time())
+        if weather is not None:
+            return weather
+
+    with cache_lock(os.path.basename(path)):
+        store = read_store()
+        if store is not None and time.time() - store["fetched_at"] <= refresh_after:
+            weather = select_current_weather(store, time.time())
+            if weather is not None:
+                return weather
+
+        try:
+            fetched = get_hourly_weather(latitude, longitude, forecast_days)
+        except FetchError:
+            # an old forecast is still better than none
+            weather = select_current_weather(store, time.time()) if store is not None else None
+            if weather is None:
+                raise
+            return weather
+        try:
+            write_file_atomically(path, pack_hourly_store(fetched))
+        except OSError:
+            pass
+
+        weather = select_current_weather(fetched, time.time())
+        if weather is None:
+            raise FetchError("The forecast returned by the API doesn't cover the current time.")
+        append_history(latitude, longitude, weather, time.time())
+    return weather
+
+
+# layout of the history files: a header followed by one fixed-width record per observation, in the order they were fetched
+HISTORY_MAGIC = b"RNYO"
+HISTORY_HEADER = "<4sHH"  # magic, version, record size
+HISTORY_RECORD = "<qfffHBx"  # observed at, temperature, apparent temperature, wind speed, wind direction, weather code
+SPARKLINE_BLOCKS = "▁▂▃▄▅▆▇█"
+
+
+def get_history_path(latitude: float, longitude: float) -> str:
+    return os.path.join(get_data_dir(), f"history_{latitude:.2f}_{longitude:.2f}.bin")
+
+
+def append_history(latitude: float, longitude: float, weather: tuple, observed_at: float) -> None:
+    """
+    Appends the passed observation to the history of the passed location. Appending is a single write to the end of the file, however long it is.
+    A new history is created with its header under a lock and moved in place atomically, so processes appending at the same time never write the header twice.
+    The history is best-effort: If it can't be written, the observation is lost.
 
     :param latitude: The latitude rounded to 2 decimal places.
     :type latitude: float
     :param longitude: The longitude rounded to 2 decimal places.
     :type longitude: float
-    :param wind_speed_unit: The unit of measurement for the speed of the wind in the format needed by the API.
-    :type wind_speed_unit: str
-    :param temperature_unit: The unit of measurement for the temperature in the format needed by the API.
-    :type temperature_unit: str
+    :param weather: The tuple returned by get_weather.
+    :type weather: tuple
+    :param observed_at: The time the weather was fetched as a Unix timestamp.
+    :type observed_at: float
+    :return: None
+    """
+    import struct
 
-    :returns: tuple: It contains the weather_code (a WMO Weather interpretation (WW) code that describes the current weather (1-99) (https://open-meteo.com/en/docs))
+    path = get_history_path(latitude, longitude)
+    record = struct.pack(HISTORY_RECORD, int(observed_at), weather[3], weather[6], weather[7], weather[8] % 65536, weather[0] % 256)
+    try:
+        if not os.path.exists(path):
+            with cache_lock(os.path.basename(path)):
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    write_file_atomically(path, struct.pack(HISTORY_HEADER, HISTORY_MAGIC, 1, struct.calcsize(HISTORY_RECORD)))
+        with open(path, "ab") as file:
+            file.write(record)
+    except OSError:
+        pass
+
+
+class History:
     """
-    forecast_api_uri = "https://api.open-meteo.com/v1/forecast"
-    params = {
-        "latitude": latitude,
-        "longitude": longitude,
-        "daily": "sunrise,sunset,temperature_2m_max,temperature_2m_min",
-        "current": "temperature_2m,apparent_temperature,weather_code,wind_speed_10m,wind_direction_10m,is_day",
-        "timezone": "auto",
-        "forecast_days": 1,
-        "wind_speed_unit": wind_speed_unit,
-        "temperature_unit": temperature_unit
-    }
-    response = requests.get(forecast_api_uri, params=params)
-    response.raise_for_status()
+    The history of a location written by append_history, memory-mapped so a query only reads the records in its time window.
+    Records are found by binary search on their timestamps, which only increase as they are appended in the order they were fetched.
 
-    data = response.json()
-    weather_code: int = int(data["current"]["weather_code"])
-    sunrise: str = "".join(data["daily"]["sunrise"])[-5:]
-    sunset: str = "".join(data["daily"]["sunset"])[-5:]
-    temperature: float = float(data["current"]["temperature_2m"])
-    temperature_max: float = float(data["daily"]["temperature_2m_max"][0])
-    temperature_min: float = float(data["daily"]["temperature_2m_min"][0])
-    apparent_temperature: float = float(data["current"]["apparent_temperature"])
-    wind_speed: float = float(data["current"]["wind_speed_10m"])
-    wind_direction: int = int(data["current"]["wind_direction_10m"])
-    is_day: bool = bool(data["current"]["is_day"])
-    return weather_code, sunrise, sunset, temperature, temperature_max, temperature_min, apparent_temperature, wind_speed, wind_direction, is_day
+    :param path: The path of the history file.
+    :raises OSError: If the file can't be opened.
+    :raises ValueError: If the file isn't a valid history or is empty.
+    """
 
-def get_weather_name(weather_code: int) -> str:
-    if weather_code == 0:
-        return "clear"
-    elif weather_code in [1, 2, 3]:
-        return "cloudy"
-    elif weather_code in [51, 53, 55, 56, 57, 61, 63, 65, 66, 67, 80, 81, 82]:
-        return "rainy"
-    elif weather_code in [71, 73, 75, 77, 85, 86]:
-        return "snowy"
-    elif weather_code in [95, 96, 99]:
-        return "thundery"
-    else:
-        return "foggy"
+    def __init__(self, path: str) -> None:
+        import mmap
+        import struct
+
+        self.header_size = struct.calcsize(HISTORY_HEADER)
+        self.record = struct.Struct(HISTORY_RECORD)
+        with open(path, "rb") as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, record_size = struct.unpack_from(HISTORY_HEADER, self.data)
+        except struct.error as error:
+            raise ValueError("The history is truncated.") from error
+        if magic != HISTORY_MAGIC or version != 1 or record_size != self.record.size:
+            raise ValueError("The history has an unknown format.")
+        # a record being appended by another process right now is left out
+        self.count = (len(self.data) - self.header_size) // self.record.size
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index: int) -> int:
+        # the timestamp of the record, so bisect can search the history directly
+        return int.from_bytes(self.data[self.header_size + index * self.record.size:self.header_size + index * self.record.size + 8], "little", signed=True)
+
+    def query(self, start: float, end: float) -> list[tuple]:
+        """
+        Gets the records observed between start and end.
+
+        :returns: list: The records as tuples of observed at, temperature, apparent temperature, wind speed, wind direction and weather code.
+        """
+        import bisect
+
+        first = bisect.bisect_left(self, start)
+        last = bisect.bisect_right(self, end, first)
+        window = memoryview(self.data)[self.header_size + first * self.record.size:self.header_size + last * self.record.size]
+        try:
+            return list(self.record.iter_unpack(window))
+        finally:
+            window.release()
+
+
+def parse_duration(value: str) -> int:
+    """
+    Parses a duration like '30m', '24h', '7d' or '2w'.
 
+    :return: The duration in seconds.
+    :raises ValueError: If the duration is invalid.
+    """
+    units = {"m": 60, "h": 3600, "d": 86400, "w": 604800}
+    if len(value) < 2 or value[-1] not in units or not value[:-1].isdigit() or int(value[:-1]) <= 0:
+        raise ValueError(f"Invalid duration {value!r}. Use a number followed by m, h, d or w, e.g. '24h' or '7d'.")
+    return int(value[:-1]) * units[value[-1]]
 
-def get_ascii_art(weather_code: int, is_day: bool = True) -> list[str]:
-    """Gets the ascii art for the passed weather_code and returns it in a list as well as the friendly name of the current weather.
 
-    :param weather_code: The code of the current weather returned by the API (a WMO Weather interpretation code (WW) 1-99. Further Information here: https://open-meteo.com/en/docs).
-    :type weather_code: int
-    :param is_day: Changes the output to sun or moon if the weather_code stands for 'clear' (Weather code = 0) [Default=True]
-    :type weather_code: boolean
+def get_sparkline(times: list[int], values: list[float], start: float, end: float, width: int = 48) -> str:
+    """
+    Draws the passed values as a sparkline of block characters. The time between start and end is split into width columns,
+    each showing the mean of the values observed in it. Columns without observations are left blank.
 
-    :returns: tuple: It contains a list of the ascii art, where on each index there's a single line of the ascii art.
-    """
-    if weather_code == 0:
-        if is_day:
-            return [
-                r"               ",
-                r"     \   /     ",
-                r"      .-.      ",
-                r"   ‒ (   ) ‒   ",
-                r"      `-᾿      ",
-                r"     /   \     ",
-                r"               "
-            ]
-        else:
-            return [
-                r"               ",
-                r"       _.._    ",
-                r"     .' .-'`   ",
-                r"    /  /       ",
-                r"    |  |       ",
-                r"    \  \       ",
-                r"     '._'-._   ",
-                r"        ```    "
-            ]
-
-    elif weather_code in [1, 2, 3]:
-        return [
+    :return: The sparkline.
+    """
+    sums = [0.0] * width
+    counts = [0] * width
+    for observed_at, value in zip(times, values):
+        column = min(width - 1, int((observed_at - start) / (end - start) * width))
+        sums[column] += value
+        counts[column] += 1
+    means = [total / count for total, count in zip(sums, counts) if count]
+    low, high = min(means), max(means)
+    scale = (len(SPARKLINE_BLOCKS) - 1) / (high - low) if high > low else 0
+    return "".join(SPARKLINE_BLOCKS[round((total / count - low) * scale)] if count else " " for total, count in zip(sums, counts))
+
+
+def render_history(config, city: str, records: list[tuple], duration: str, start: float, end: float) -> str:
+    """
+    Renders the minimum, maximum and mean as well as a sparkline of the temperatures and wind speeds of the passed records, in the units of the configuration.
+
+    :param config: The configuration returned by load_config.
+    :type config: dict
+    :param city: The name of the city the records are for.
+    :type city: str
+    :param records: The records returned by History.query.
+    :type records: list
+    :param duration: The duration the records were queried for as passed to --history.
+    :type duration: str
+    :return: The rendered report.
+    """
+    if not records:
+        return f"No weather has been recorded for {city} in the last {duration}.\n"
+
+    factor, offset = config.get("temperature_conversion")
+    speed_factor = config.get("speed_conversion")
+    times = [record[0] for record in records]
+    series = (
+        ("Temperature", [record[1] * factor + offset for record in records], config.get("temperature_unit")),
+        ("Feels like", [record[2] * factor + offset for record in records], config.get("temperature_unit")),
+        ("Wind speed", [record[3] * speed_factor for record in records], " " + config.get("speed_unit")),
+    )
+
+    lines = [f"{city}, last {duration} ({len(records)} observations)"]
+    for name, values, unit in series:
+        statistics = f"min {min(values):.1f}{unit}  max {max(values):.1f}{unit}  mean {sum(values) / len(values):.1f}{unit}"
+        lines.append(f"{name:<12}{statistics:<52}{get_sparkline(times, values, start, end)}")
+
+    theme = get_theme(config)
+    weather_names = [theme.get_weather_name(record[5]) for record in records]
+    lines.append(f"{'Weather':<12}mostly {max(dict.fromkeys(weather_names), key=weather_names.count)}")
+    return "".join(line + "\n" for line in lines)
+
+
+# the default theme, see Theme. A theme file only needs to contain the entries it changes
+DEFAULT_THEME = {
+    # the WMO weather interpretation codes (https://open-meteo.com/en/docs) of each weather, any other code is default_weather
+    "weathers": {
+        "clear": [0],
+        "cloudy": [1, 2, 3],
+        "foggy": [45, 48],
+        "rainy": [51, 53, 55, 56, 57, 61, 63, 65, 66, 67, 80, 81, 82],
+        "snowy": [71, 73, 75, 77, 85, 86],
+        "thundery": [95, 96, 99],
+    },
+    "default_weather": "foggy",
+    # the ASCII art of each weather, '<weather> night' is used at night if present
+    "art": {
+        "clear": [
+            r"               ",
+            r"     \   /     ",
+            r"      .-.      ",
+            r"   ‒ (   ) ‒   ",
+            r"      `-᾿      ",
+            r"     /   \     ",
+            r"               ",
+        ],
+        "clear night": [
+            r"               ",
+            r"       _.._    ",
+            r"     .' .-'`   ",
+            r"    /  /       ",
+            r"    |  |       ",
+            r"    \  \       ",
+            r"     '._'-._   ",
+            r"        ```    ",
+        ],
+        "cloudy": [
             r"                 ",
             r"       .--.      ",
             r"    .-(    ).    ",
@@ -198,9 +1903,8 @@ def get_ascii_art(weather_code: int, is_day: bool = True) -> list[str]:
             r"                 ",
             r"                 ",
             r"                 ",
-        ]
-    elif weather_code in [51, 53, 55, 56, 57, 61, 63, 65, 66, 67, 80, 81, 82]:
-        return [
+        ],
+        "rainy": [
             r"                 ",
             r"       .--.      ",
             r"    .-(    ).    ",
@@ -208,9 +1912,8 @@ def get_ascii_art(weather_code: int, is_day: bool = True) -> list[str]:
             r"    ʻ‚ʻ‚ʻ‚ʻ‚ʻ    ",
             r"                 ",
             r"                 ",
-        ]
-    elif weather_code in [71, 73, 75, 77, 85, 86]:
-        return [
+        ],
+        "snowy": [
             r"                 ",
             r"       .--.      ",
             r"    .-(    ).    ",
@@ -218,9 +1921,8 @@ def get_ascii_art(weather_code: int, is_day: bool = True) -> list[str]:
             r"    * * * * *    ",
             r"                 ",
             r"                 ",
-        ]
-    elif weather_code in [95, 96, 99]:
-        return [
+        ],
+        "thundery": [
             r"                 ",
             r"       .--.      ",
             r"    .-(    ).    ",
@@ -228,85 +1930,222 @@ def get_ascii_art(weather_code: int, is_day: bool = True) -> list[str]:
             r"        /_       ",
             r"         /       ",
             r"                 ",
-        ]
-    else:
-        return [
-            r"                            "
-            r"~~~~   ~~~~ ~~~   * ~~~~~~~ "
-            r"~~~   *  ~~~~~  * ~~~~  ~~~~"
-            r"  ~~~~  ~~~ * ~~~~~ ~~~~   ~"
-            r"~~~~*   ~~~~   * ~~~~   ~~~~"
-            r"  * ~~~ ~~~~  ~~~~~  * ~~~~ "
-            r"                            "
-        ]
-
-
-def get_emoji(key: str) -> emoji:
-    """
-    Gets the emoji for the passed key.
-    If the key is not valid or unset, it returns an empty string.
-
-    :param key: A key of an entry in the dictionary 'values'
-    :type: key: string
-    :return: An emoji that represents the key passed into it. If the key is not valid or unset, it returns an empty string.
-    """
-    if key == "city":
-        return emoji.emojize(":derelict_house:")
-    elif key == "weather":
-        return emoji.emojize(":sun_behind_rain_cloud:")
-    elif key == "temperature":
-        return emoji.emojize(":thermometer:")
-    elif key == "wind speed":
-        return emoji.emojize(":dashing_away:")
-    elif key == "wind direction":
-        return emoji.emojize(":compass:")
-    elif key == "sunrise":
-        return emoji.emojize(":sunrise:")
-    elif key == "sunset":
-        return emoji.emojize(":sunset:")
-    elif key == "date":
-        return emoji.emojize(":calendar:")
-    elif key == "time":
-        return emoji.emojize(":alarm_clock:")
-    else:
-        return ""
-
-def get_color(key: str) -> str:
-    """
-    Gets the color for the passed key.
-    If the key is not valid or unset, it returns the color 'white'.
-
-    :param key: A key of an entry in the dictionary 'values'
-    :type: key: string
-    :return: A string containing the color for the termcolor output depending on the passed key. If the key is not valid or unset, it returns the color 'white'.
-    """
-    if key == "city":
-        return "blue"
-    elif key == "weather":
-        return "cyan"
-    elif key == "temperature":
-        return "red"
-    elif key == "wind speed":
-        return "green"
-    elif key == "wind direction":
-        return "yellow"
-    elif key == "sunrise":
-        return "magenta"
-    elif key == "sunset":
-        return "magenta"
-    else:
-        return "white"
+        ],
+        "foggy": [
+            r"                            ",
+            r"~~~~   ~~~~ ~~~   * ~~~~~~~ ",
+            r"~~~   *  ~~~~~  * ~~~~  ~~~~",
+            r"  ~~~~  ~~~ * ~~~~~ ~~~~   ~",
+            r"~~~~*   ~~~~   * ~~~~   ~~~~",
+            r"  * ~~~ ~~~~  ~~~~~  * ~~~~ ",
+            r"                            ",
+        ],
+    },
+    # the termcolor color of each line, any other line is default_color
+    "colors": {
+        "city": "blue",
+        "weather": "cyan",
+        "temperature": "red",
+        "wind speed": "green",
+        "wind direction": "yellow",
+        "sunrise": "magenta",
+        "sunset": "magenta",
+    },
+    "default_color": "white",
+    # the emoji shown in front of each line
+    "emoji": {
+        "city": "\U0001F3DA\uFE0F",  # :derelict_house:
+        "weather": "\U0001F326\uFE0F",  # :sun_behind_rain_cloud:
+        "temperature": "\U0001F321\uFE0F",  # :thermometer:
+        "wind speed": "\U0001F4A8",  # :dashing_away:
+        "wind direction": "\U0001F9ED",  # :compass:
+        "sunrise": "\U0001F305",  # :sunrise:
+        "sunset": "\U0001F307",  # :sunset:
+        "date": "\U0001F4C5",  # :calendar:
+        "time": "\u23F0",  # :alarm_clock:
+    },
+    # the emoji of each weather, for --format
+    "weather_emoji": {
+        "clear": "\u2600\uFE0F",  # :sun:
+        "cloudy": "\u2601\uFE0F",  # :cloud:
+        "rainy": "\U0001F327\uFE0F",  # :cloud_with_rain:
+        "snowy": "\U0001F328\uFE0F",  # :cloud_with_snow:
+        "thundery": "\u26C8\uFE0F",  # :cloud_with_lightning_and_rain:
+        "foggy": "\U0001F32B\uFE0F",  # :fog:
+    },
+}
+
+# the themes loaded so far by their path, see get_theme
+_themes: dict = {}
+
+
+class Theme:
+    """
+    The names, ASCII art, colors and emoji the weather is rendered with, compiled into lookup tables once.
+    The parts of each output line that only depend on the theme and the configuration are built on first use and reused for every following render.
+
+    :param definition: The theme in the format of DEFAULT_THEME.
+    :raises ValueError: If the definition is invalid.
+    """
+
+    def __init__(self, definition: dict) -> None:
+        try:
+            self.default_weather = str(definition["default_weather"])
+            self.names = [self.default_weather] * 100
+            for name, codes in definition["weathers"].items():
+                for code in codes:
+                    self.names[int(code)] = name
+            self.art = {name: tuple(str(line) for line in lines) for name, lines in definition["art"].items()}
+            self.colors = {key: str(color) for key, color in definition["colors"].items()}
+            self.default_color = str(definition["default_color"])
+            self.emoji = {key: str(emoji) for key, emoji in definition["emoji"].items()}
+            self.weather_emoji = {name: str(emoji) for name, emoji in definition["weather_emoji"].items()}
+        except (KeyError, TypeError, AttributeError, IndexError) as error:
+            raise ValueError(f"Invalid theme: {error!r}") from error
+        if self.default_weather not in self.art:
+            raise ValueError(f"Invalid theme: no art for {self.default_weather!r}")
+        for name, art in self.art.items():
+            if not art:
+                raise ValueError(f"Invalid theme: the art for {name!r} is empty")
+        # the colors of the default theme are known to be valid, so termcolor is only imported for others
+        colors = {*self.colors.values(), self.default_color} - {*DEFAULT_THEME["colors"].values(), DEFAULT_THEME["default_color"]}
+        if colors:
+            with trace.importing("termcolor"):
+                import termcolor
+
+            for color in sorted(colors):
+                if color not in termcolor.COLORS:
+                    raise ValueError(f"Invalid theme: unknown color {color!r}. Available colors: {', '.join(termcolor.COLORS)}")
+        self.segments: dict = {}
+        self.frames: dict = {}
+
+    def get_weather_name(self, weather_code: int) -> str:
+        return self.names[weather_code] if 0 <= weather_code < len(self.names) else self.default_weather
+
+    def get_ascii_art(self, weather_code: int, is_day: bool = True) -> tuple[str, ...]:
+        name = self.get_weather_name(weather_code)
+        if not is_day and f"{name} night" in self.art:
+            return self.art[f"{name} night"]
+        return self.art.get(name, self.art[self.default_weather])
+
+    def get_segments(self, use_emoji: bool, color: bool) -> dict[str, tuple[str, str]]:
+        """
+        Gets the text in front of and behind the value of each output line, including the emoji, the label and the ANSI color codes.
+
+        :param use_emoji: Include the emoji.
+        :type use_emoji: bool
+        :param color: Include the ANSI color codes.
+        :type color: bool
+        :return: The prefix on index 0 and the suffix on index 1 of each line, by key.
+        """
+        segments = self.segments.get((use_emoji, color))
+        if segments is None:
+            if color:
+                with trace.importing("termcolor"):
+                    import termcolor
+
+            segments = {}
+            for key in ("city", "weather", "temperature", "wind speed", "wind direction", "sunrise", "sunset", "date", "time"):
+                start, end = termcolor.colored("\0", self.colors.get(key, self.default_color), force_color=True).split("\0") if color else ("", "")
+                segments[key] = (f"{start}{self.emoji.get(key, '') if use_emoji else ''} {key.capitalize()}: ", end)
+            self.segments[(use_emoji, color)] = segments
+        return segments
+
+    def get_frame(self, ascii_art: tuple[str, ...], lines: int) -> tuple[str, ...]:
+        """
+        Gets the passed ASCII art padded with blank lines of the same width to at least the passed number of lines.
+
+        :return: The padded ASCII art.
+        """
+        frame = self.frames.get((ascii_art, lines))
+        if frame is None:
+            frame = self.frames[(ascii_art, lines)] = tuple(ascii_art) + (" " * len(ascii_art[0]),) * (lines - len(ascii_art))
+        return frame
+
+
+def load_theme(path: str) -> Theme:
+    """
+    Loads the theme file at the passed path. It is a JSON object with any of the entries of DEFAULT_THEME, which replace the default ones.
+    The entries 'weathers', 'art', 'colors', 'emoji' and 'weather_emoji' are merged with the default ones, so a theme only needs to contain what it changes.
+    If the file can't be loaded, the default theme is used.
+
+    :param path: The path of the theme file, or an empty string for the default theme.
+    :type path: str
+    :return: The compiled theme.
+    """
+    definition = dict(DEFAULT_THEME)
+    if path:
+        try:
+            with open(path, encoding="utf-8") as file:
+                theme = json.load(file)
+            for key, value in theme.items():
+                definition[key] = {**definition[key], **value} if isinstance(definition.get(key), dict) and isinstance(value, dict) else value
+            return Theme(definition)
+        except (OSError, ValueError, AttributeError) as error:
+            # on stderr, so it doesn't end up in the single line of --format and --json
+            print(f"Couldn't load the theme {path!r}: {error}. Using default.", file=sys.stderr)
+            definition = DEFAULT_THEME
+    return Theme(definition)
+
+
+def get_theme(config=None) -> Theme:
+    """
+    Gets the theme set in the passed configuration, loading and compiling it the first time it is needed.
+
+    :param config: The configuration returned by load_config, or None for the default theme.
+    :type config: dict
+    :return: The compiled theme.
+    """
+    path = config.get("theme", "") if config else ""
+    theme = _themes.get(path)
+    if theme is None:
+        theme = _themes[path] = load_theme(path)
+    return theme
+
+
+def get_weather_name(weather_code: int, theme: Theme | None = None) -> str:
+    return (theme or get_theme()).get_weather_name(weather_code)
 
 
-def output(config, ascii_art: list[str] | None, city: str, weather: str | None, temperature_str: str, wind_speed_str: str, wind_direction_str: str | None, sunrise: str, sunset: str, current_date: str | None, current_time: str) -> None:
+def get_ascii_art(weather_code: int, is_day: bool = True, theme: Theme | None = None) -> tuple[str, ...]:
+    """Gets the ascii art for the passed weather_code from the passed theme.
+
+    :param weather_code: The code of the current weather returned by the API (a WMO Weather interpretation code (WW) 1-99. Further Information here: https://open-meteo.com/en/docs).
+    :type weather_code: int
+    :param is_day: Changes the output to sun or moon if the weather_code stands for 'clear' (Weather code = 0) [Default=True]
+    :type weather_code: boolean
+    :param theme: The theme to take the art from, or None for the default theme.
+    :type theme: Theme
+
+    :returns: tuple: The lines of the ascii art. It is shared between calls and must not be changed.
+    """
+    return (theme or get_theme()).get_ascii_art(weather_code, is_day)
+
+
+def colors_enabled(force_color: bool | None = None) -> bool:
+    """
+    Checks if termcolor would color the output, which depends on the terminal and the NO_COLOR and FORCE_COLOR environment variables.
+
+    :param force_color: If True or False, colors are always or never used instead of only when printing to a terminal.
+    :type force_color: bool
+    :return: True if the output should be colored.
+    """
+    with trace.importing("termcolor"):
+        import termcolor
+
+    return termcolor.colored("\0", "white", no_color=force_color is False or None, force_color=force_color or None) != "\0"
+
+
+def render_output(config, ascii_art: tuple[str, ...] | None, city: str, weather: str | None, temperature_str: str, wind_speed_str: str, wind_direction_str: str | None, sunrise: str, sunset: str, current_date: str | None, current_time: str, force_color: bool | None = None) -> str:
     """
-    Prints the output of rainy to the terminal. It can take any amount of parameters. If no parameter is passed, the output will only be the ascii art of the current weather.
+    Renders the output of rainy into a string. It can take any amount of parameters. If no parameter is passed, the output will only be the ascii art of the current weather.
     If the amount of lines needed to display the passed parameters, it will expand the ascii art with blank lines in the same amount of characters and add the value behind it.
     
-    It will not return anything in any case.
+    Lines are colored, if enabled in the configuration, with the colors of the theme.
+    The emoji, labels and color codes of the lines are built once per theme and configuration, see Theme.get_segments.
 
-    :param ascii_art: Takes in a list of strings containing a single line of the ascii art per index.
-    :type ascii_art: list
+    :param ascii_art: Takes in a tuple of strings containing a single line of the ascii art per index.
+    :type ascii_art: tuple
     :param city: Takes in the name of the city requested.
     :type city: str
     :param weather: Takes in the current weather.
@@ -325,7 +2164,9 @@ def output(config, ascii_art: list[str] | None, city: str, weather: str | None,
     :type current_date: str
     :param current_time: Takes in the current time. Format depends on the configuration and is already passed formated.
     :type current_time: str
-    :return: None
+    :param force_color: If True or False, colors are always or never used instead of only when printing to a terminal. Has no effect if use_color is disabled.
+    :type force_color: bool
+    :return: The rendered lines, each terminated by a newline.
     """
     values: dict = {}
     if config.get("show_city"):
@@ -347,96 +2188,119 @@ def output(config, ascii_art: list[str] | None, city: str, weather: str | None,
     if config.get("show_time"):
         values["time"] = current_time
 
+    theme = get_theme(config)
+    segments = theme.get_segments(config.get("use_emoji") is True, bool(config.get("use_color")) and colors_enabled(force_color))
+    lines = [f"{segments[key][0]}{value}{segments[key][1]}" for key, value in values.items()]
+
     if config.get("show_ascii_art"):
-        len_diff = len(values) - len(ascii_art)
-        if len_diff > 0:
-            for _ in range(len_diff):
-                ascii_art.append(" " * len(ascii_art[0]))
+        frame = theme.get_frame(tuple(ascii_art), len(lines))
+        lines = [frame[i] + line for i, line in enumerate(lines)]
 
-        for i, (key, value) in enumerate(values.items()):
-            try:
-                if config.get("use_color"):
-                    print(ascii_art[i], end="")
-                    termcolor.cprint(f"{get_emoji(key) if config.get("use_emoji") is True else ""} {key.capitalize()}: {value}", f"{get_color(key)}")
-                else:
-                    print(f"{ascii_art[i]}{get_emoji(key) if config.get("use_emoji") is True else ""} {key.capitalize()}: {value}")
-            except IndexError:
-                print(ascii_art[i])
-    else:
-        for key, value in values.items():
-            if config.get("use_color"):
-                termcolor.cprint(f"{get_emoji(key) if config.get("use_emoji") is True else ""} {key.capitalize()}: {value}", f"{get_color(key)}")
-            else:
-                print(f"{get_emoji(key) if config.get("use_emoji") is True else ""} {key.capitalize()}: {value}")
-
-def get_api_speed_unit(unit: str) -> str:
-    """
-    Convert any speed unit into the API representation for the API Call.
-    If an invalid unit is requested, it will return the default unit.
-    Default: "kmh" (km/h)
-    :param unit: This is the speed unit to get the API representation for.
-    :type unit: str
-    :return: API representation of the requested unit
-    """
-    if unit == "mph":
-        return "mph"
-    elif unit == "km/h":
-        return "kmh"
-    elif unit == "m/s":
-        return "ms"
-    elif unit.lower() == "knots":
-        return "kn"
-    else:
-        print("Invalid wind speed unit. Please use supported unit. Using default.")
-        return "kmh"
-
-def get_api_temperature_unit(unit: str) -> str:
-    """
-    Convert any temperature unit into the API representation for the API Call.
-    The API can't handle kelvin, which means it has to be converted afterward. For easy conversion, Celsius will be used for the API call.
-    If an invalid unit is requested, it will return the default unit.
-    Default: "celsius" (Celsius)
-    :param unit: This is the temperature unit to get the API representation for.
-    :type unit: str
-    :return: API representation of the requested unit
-    """
-    if unit == "°C":
-        return "celsius"
-    elif unit == "°F":
-        return "fahrenheit"
-    elif unit == "°K":
-        return "celsius"
-    else:
-        print("Invalid temperature unit. Please use supported unit. Using default.")
-        return "celsius"
+    return "".join(line + "\n" for line in lines)
+
+
+def output(config, ascii_art: tuple[str, ...] | None, city: str, weather: str | None, temperature_str: str, wind_speed_str: str, wind_direction_str: str | None, sunrise: str, sunset: str, current_date: str | None, current_time: str) -> None:
+    """
+    Prints the output of rainy to the terminal.
+    The parameters are the same as for render_output.
+
+    It will not return anything in any case.
+
+    :return: None
+    """
+    print(render_output(config, ascii_art, city, weather, temperature_str, wind_speed_str, wind_direction_str, sunrise, sunset, current_date, current_time), end="")
 
 
-def create_parser() -> argparse.PARSER:
+# the factor and offset converting the temperatures fetched from the API into each supported unit
+TEMPERATURE_CONVERSIONS = {
+    "°C": (1.0, 0.0),
+    "°F": (1.8, 32.0),
+    "°K": (1.0, 273.15),
+}
+
+# the factor converting the wind speed fetched from the API into each supported unit
+SPEED_CONVERSIONS = {
+    "km/h": 1.0,
+    "mph": 1 / 1.609344,
+    "m/s": 1 / 3.6,
+    "knots": 1 / 1.852,
+}
+
+
+def convert_units(config, forecasts: list[tuple]) -> list[tuple]:
+    """
+    Converts the passed forecasts from the units they are fetched and cached in into the units set in the configuration.
+    The values are converted one column at a time with the conversions resolved by compile_config.
+
+    :param config: The configuration returned by load_config.
+    :type config: dict
+    :param forecasts: The tuples returned by get_forecast.
+    :type forecasts: list
+    :return: The forecasts with temperatures and wind speeds rounded to 1 decimal place in the configured units.
+    """
+    if not forecasts:
+        return []
+
+    factor, offset = config.get("temperature_conversion")
+    speed_factor = config.get("speed_conversion")
+    if (factor, offset, speed_factor) == (1.0, 0.0, 1.0):
+        return list(forecasts)
+
+    columns = list(zip(*forecasts))
+    # temperature, temperature_max, temperature_min and apparent_temperature; None if not fetched
+    for index in (3, 4, 5, 6):
+        columns[index] = [None if value is None else round(value * factor + offset, 1) for value in columns[index]]
+    columns[7] = [None if value is None else round(value * speed_factor, 1) for value in columns[7]]
+    return list(zip(*columns))
+
+
+def create_parser() -> argparse.ArgumentParser:
+    with trace.importing("argparse"):
+        import argparse
+
     parser = argparse.ArgumentParser(
         prog="Rainy",
         description="Neofetch-like, minimalistic, and customizable weather-fetching tool.",
         epilog="Example: %(prog)s --city-name Potsdam --country-code DE"
     )
-    parser.add_argument("-city, --city-name", dest="city_name", help="Specify the city name to look for. For example for Potsdam the cit name would be 'Potsdam'. If not specified, looks up location by your public IP.", type=str)
+    parser.add_argument("-city", "--city-name", dest="city_name", nargs="+", help="Specify the city name to look for. For example for Potsdam the cit name would be 'Potsdam'. If not specified, looks up location by your public IP. If multiple city names are passed, the weather is shown for each of them.", type=str)
     parser.add_argument("-country", "--country-code", dest="country_code", help="Specify the country code for the country to look for the specified city . A List of Country Codes can be found here: https://en.wikipedia.org/wiki/ISO_3166-1_alpha-2#Officially_assigned_code_elements", type=str)
+    parser.add_argument("--locations-file", dest="locations_file", help="Specify a file with one location per line to show the weather for, each written as 'city name' or 'city name, country code'. Empty lines and lines starting with '#' are ignored.", type=str)
+    parser.add_argument("--table", dest="table", action="store_true", help="Show multiple locations as a compact table instead of one block per location.")
+    parser.add_argument("--daemon", dest="daemon", action="store_true", help="Keep running in the background, refresh the weather periodically and serve the output to 'rainy --client'.")
+    parser.add_argument("--format", dest="format", metavar="TEMPLATE", help="Print a single line rendered from TEMPLATE instead of the usual output, e.g. '{emoji} {temperature} {wind_speed}'. Available fields: city, weather, emoji, temperature, temperature_max, temperature_min, apparent_temperature, wind_speed, wind_direction, sunrise, sunset, date and time.", type=str)
+    parser.add_argument("--json", dest="json", action="store_true", help="Print the weather as a single line of JSON instead of the usual output.")
+    parser.add_argument("--watch", dest="watch", metavar="INTERVAL", help="Keep showing the weather, update the time every second and refresh the weather every INTERVAL seconds, but only once the upstream data can have changed.", type=float)
+    parser.add_argument("--serve", dest="serve", metavar="ADDRESS", nargs="?", const="127.0.0.1:8080", help="Serve the weather over HTTP on ADDRESS (PORT or HOST:PORT, default 127.0.0.1:8080), e.g. 'curl localhost:8080/?city=Potsdam'. Add '&format=json' for JSON or '&template=...' for a --format template.", type=str)
+    parser.add_argument("--client", dest="client", action="store_true", help="Print the output of a running rainy daemon. If no daemon is running, rainy runs normally.")
+    parser.add_argument("--timings", dest="timings", action="store_true", help="Print how long each phase of the run took, as well as details on each request and cache lookup, to stderr.")
+    parser.add_argument("--trace-file", dest="trace_file", help="Append the same data as --timings to the specified file as JSON lines.", type=str)
+    parser.add_argument("--build-geoindex", dest="build_geoindex", metavar="DUMP", help="Build the offline geocoding index from a GeoNames cities dump, like cities500.zip from https://download.geonames.org/export/dump/. Cities found in it are looked up without a request.", type=str)
+    parser.add_argument("--history", dest="history", metavar="DURATION", help="Show the minimum, maximum and mean temperature and wind speed recorded over the last DURATION, e.g. '24h' or '7d', along with sparklines. Every fetched observation is recorded.", type=str)
+    parser.add_argument("--quota", dest="quota", action="store_true", help="Show how many requests all rainy processes on this host sent to each API today and this month, against the limits set in the configuration.")
+    parser.add_argument("--refresh", dest="refresh", action="store_true", help=argparse.SUPPRESS)
 
     return parser
 
 
-def get_current_date(format: str):
-    if format == "MM/DD/YYYY":
-        return datetime.datetime.now().strftime("%m/%d/%Y")
-    elif format == "DD/MM/YYYY":
-        return datetime.datetime.now().strftime("%d/%m/%Y")
-    elif format == "YYYY/MM/DD":
-        format = datetime.datetime.now().strftime("%Y/%m/%d")
-    elif format == "YYYY-MM-DD":
-        return datetime.datetime.now().strftime("%Y-%m-%d")
-    elif format == "DD.MM.YYYY":
-        return datetime.datetime.now().strftime("%d.%m.%Y")
-    else:
-        print("Invalid date format. Please use supported date format. Using default.")
-        return datetime.datetime.now().strftime("%M/%D/%Y")
+def get_current_time(pattern: str) -> str:
+    """
+    Formats the current local date or time with the passed strftime pattern, like the date_pattern or time_pattern of the configuration.
+    """
+    return time.strftime(pattern)
+
+
+def format_time_of_day(config, value: str) -> str:
+    """
+    Formats the passed time of day, like the sunrise, according to the time_format of the configuration.
+
+    :param value: The time of day as returned by the API, e.g. '18:12'.
+    :type value: str
+    :return: The formatted time of day.
+    """
+    if config.get("time_of_day_pattern") == "%H:%M":
+        return value
+    return time.strftime(config.get("time_of_day_pattern"), time.strptime(value, "%H:%M"))
 
 
 def get_wind_direction(wind_direction: int) -> str:
@@ -449,78 +2313,894 @@ def get_wind_direction(wind_direction: int) -> str:
     else:
         return "West"
 
-def main() -> None:
-    # parse CLI arguments
-    parser = create_parser()
-    try:
-        args = parser.parse_args()
-    except SystemExit:
-        # Help was triggered or parsing failed
-        exit()
+def get_location(args, config) -> tuple[float, float, str]:
+    """
+    Gets the location to get the weather for.
+    A city name passed as CLI argument takes precedence over the one in the configuration. If neither is set, the location is looked up by the public IP.
 
-    if args.country_code and not args.city_name:
-        raise Exception("--country-code requires --city-name")
+    :param args: The parsed CLI arguments.
+    :param config: The configuration returned by load_config.
+    :type config: dict
+    :returns: tuple: It contains the latitude on index 0, longitude on index 1 and the city on index 2
+    """
+    if args.city_name:
+        return get_cached_location_by_city_name(args.city_name[0], args.country_code, config.get("location_ttl"))
+    elif config.get("city_name"):
+        return get_cached_location_by_city_name(config.get("city_name"), config.get("country_code"), config.get("location_ttl"))
+    else:
+        return get_cached_location_by_ip(config.get("location_ttl"))
+
+
+def get_forecast(config, latitude: float, longitude: float, fields: tuple[str, ...] = WEATHER_FIELDS, fetched_after: float = 0) -> tuple[int, str, str, float, float, float, float, float, int, bool]:
+    """
+    Gets the weather for the passed location in the units it is fetched in, see convert_units.
 
-    config = load_config()
+    :param config: The configuration returned by load_config.
+    :type config: dict
+    :param latitude: The latitude rounded to 2 decimal places.
+    :type latitude: float
+    :param longitude: The longitude rounded to 2 decimal places.
+    :type longitude: float
+    :param fields: The variables needed, see get_weather_fields. The hourly forecast always contains all of them.
+    :type fields: tuple
+    :param fetched_after: A cached forecast fetched before this time (a Unix timestamp) isn't used, see get_cached_weather. The hourly forecast covers the coming days, so it is used anyway.
+    :type fetched_after: float
+    :returns: tuple: The same tuple get_weather returns.
+    """
+    if config.get("forecast_mode") == "hourly":
+        return get_cached_hourly_weather(latitude, longitude, config.get("forecast_days"), config.get("hourly_refresh_after"))
+    return get_cached_weather(latitude, longitude, config.get("weather_ttl"), fields, fetched_after)
 
-    # Setup units according to configuration
-    api_speed_unit = get_api_speed_unit(config.get("speed_unit"))
-    api_temperature_unit = get_api_temperature_unit(config.get("temperature_unit"))
 
+def get_cached_forecast(config, latitude: float, longitude: float, fields: tuple[str, ...] = WEATHER_FIELDS) -> tuple[tuple, float, bool] | None:
+    """
+    Gets the cached forecast for the passed location together with its age, if it contains the passed fields and is younger than weather_hard_ttl (or weather_ttl, if that's longer).
+    If it is older than weather_ttl and the API didn't allow reusing it for longer, it is stale: It is shown right away while a background refresh fetches a new one.
 
-    if args.city_name:
-        if args.country_code:
-            latitude, longitude, city = get_location_by_city_name(args.city_name, args.country_code)
-        else:
-            latitude, longitude, city = get_location_by_city_name(args.city_name)
-    elif config.get("city_name"):
-        if config.get("country_code"):
-            latitude, longitude, city = get_location_by_city_name(config.get("city_name"), config.get("country_code"))
-        else:
-            latitude, longitude, city = get_location_by_city_name(config.get("city_name"))
+    :param config: The configuration returned by load_config.
+    :type config: dict
+    :param latitude: The latitude rounded to 2 decimal places.
+    :type latitude: float
+    :param longitude: The longitude rounded to 2 decimal places.
+    :type longitude: float
+    :param fields: The variables needed, see get_weather_fields.
+    :type fields: tuple
+    :returns: tuple: The forecast on index 0, its age in seconds on index 1 and whether it is stale on index 2, or None if there is no such forecast.
+    """
+    if config.get("weather_ttl") <= 0 or config.get("forecast_mode") == "hourly":
+        return None
+
+    entry = read_weather_cache(get_weather_cache_name(latitude, longitude))
+    if not is_weather_usable(entry, max(config.get("weather_ttl"), config.get("weather_hard_ttl")), fields):
+        return None
+    return tuple(entry["weather"]), time.time() - entry["fetched_at"], not is_weather_usable(entry, config.get("weather_ttl"), fields)
+
+
+def start_background_refresh() -> None:
+    """
+    Starts a detached 'rainy --refresh' with the current CLI arguments, which updates the cache for the next run.
+    While a refresh started less than a minute ago is still running, no other one is started.
+
+    :return: None
+    """
+    import subprocess
+
+    lock_path = os.path.join(get_cache_dir(), "refresh.lock")
+    try:
+        if time.time() - os.path.getmtime(lock_path) < 60:
+            return
+    except OSError:
+        pass
+
+    try:
+        os.makedirs(get_cache_dir(), exist_ok=True)
+        open(lock_path, "w").close()
+    except OSError:
+        return
+
+    if os.name == "nt":
+        detach = {"creationflags": subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP}
     else:
-        latitude, longitude, city = get_location_by_ip()
+        detach = {"start_new_session": True}
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--refresh", *sys.argv[1:]],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        **detach
+    )
 
-    weather_code, sunrise, sunset, temperature, temperature_max, temperature_min, apparent_temperature, wind_speed, wind_direction, is_day = get_weather(latitude, longitude, api_speed_unit, api_temperature_unit)
 
-    # converting Celsius returned by api into kelvin
-    if config.get("temperature_unit") == "°K":
-        temperature = round(temperature + 273.2, 1)
-        apparent_temperature = round(apparent_temperature + 273.2, 1)
-        temperature_min = round(temperature_min + 273.2, 1)
-        temperature_max = round(temperature_max + 273.2, 1)
+def refresh(args, config) -> None:
+    """
+    Fetches the location and forecast into the cache without printing anything. This is what the background refresh runs.
+
+    :param args: The parsed CLI arguments.
+    :param config: The configuration returned by load_config.
+    :type config: dict
+    :return: None
+    """
+    try:
+        latitude, longitude, _ = get_location(args, config)
+        get_forecast(config, latitude, longitude, get_weather_fields(config, args))
+    except (FetchError, ValueError):
+        pass
+    finally:
+        try:
+            os.unlink(os.path.join(get_cache_dir(), "refresh.lock"))
+        except OSError:
+            pass
+
+
+def format_weather(config, forecast: tuple) -> dict[str, str]:
+    """
+    Formats the values of the passed forecast for display according to the configuration.
+
+    :param config: The configuration returned by load_config.
+    :type config: dict
+    :param forecast: The tuple returned by get_forecast, converted by convert_units.
+    :type forecast: tuple
+    :return: A dictionary containing the formatted 'weather', 'temperature', 'wind speed', 'wind direction', 'sunrise' and 'sunset'. Values that weren't fetched are empty.
+    """
+    weather_code, sunrise, sunset, temperature, temperature_max, temperature_min, apparent_temperature, wind_speed, wind_direction, is_day = forecast
 
-    wind_speed_str = f"{wind_speed} {config.get("speed_unit")}"
-    temperature_str = f"{temperature}{config.get("temperature_unit")}"
+    wind_speed_str = f"{wind_speed} {config.get('speed_unit')}"
+    temperature_str = f"{temperature}{config.get('temperature_unit')}"
 
     # adds apparent temperature to temperature output
     if config.get("show_apparent_temperature"):
-        temperature_str += f" feels like {apparent_temperature}{config.get("temperature_unit")}"
+        temperature_str += f" feels like {apparent_temperature}{config.get('temperature_unit')}"
     if config.get("show_max_and_min_temperature"):
-        temperature_str += f" ({temperature_max}{config.get("temperature_unit")} ↑ | {temperature_min}{config.get("temperature_unit")} ↓)"
+        temperature_str += f" ({temperature_max}{config.get('temperature_unit')} ↑ | {temperature_min}{config.get('temperature_unit')} ↓)"
+
+    return {
+        "weather": "" if weather_code is None else get_weather_name(weather_code, get_theme(config)),
+        "temperature": "" if temperature is None else temperature_str,
+        "wind speed": "" if wind_speed is None else wind_speed_str,
+        "wind direction": "" if wind_direction is None else get_wind_direction(wind_direction),
+        "sunrise": "" if sunrise is None else format_time_of_day(config, sunrise),
+        "sunset": "" if sunset is None else format_time_of_day(config, sunset),
+    }
 
-    date = get_current_date(config.get("date_format"))
 
-    if config.get("time_format") == 12:
-        current_time = datetime.datetime.now().strftime("%I:%M:%S %p")
+def render_weather(config, city: str, forecast: tuple, force_color: bool | None = None) -> str:
+    """
+    Formats the passed forecast according to the configuration and renders it using render_output.
+
+    :param config: The configuration returned by load_config.
+    :type config: dict
+    :param city: The name of the city the forecast is for.
+    :type city: str
+    :param forecast: The tuple returned by get_forecast.
+    :type forecast: tuple
+    :param force_color: Passed on to render_output.
+    :type force_color: bool
+    :return: The rendered output.
+    """
+    values = format_weather(config, convert_units(config, [forecast])[0])
+
+    date = get_current_time(config.get("date_pattern"))
+    current_time = get_current_time(config.get("time_pattern"))
+
+    ascii_art = get_ascii_art(forecast[0], forecast[9], get_theme(config)) if config.get("show_ascii_art") else None
+
+    return render_output(config, ascii_art, city, values["weather"], values["temperature"], values["wind speed"], values["wind direction"], values["sunrise"], values["sunset"], date, current_time, force_color)
+
+
+def render_table(config, rows: list[tuple[str, tuple]]) -> str:
+    """
+    Renders the weather of multiple locations as a compact table with one row per location.
+    Only the columns enabled in the Show section of the configuration are included. Date and time are left out.
+
+    :param config: The configuration returned by load_config.
+    :type config: dict
+    :param rows: The name of each city on index 0 and the tuple returned by get_forecast on index 1.
+    :type rows: list
+    :return: The rendered table.
+    """
+    keys = [key for key in ("city", "weather", "temperature", "wind speed", "wind direction", "sunrise", "sunset") if config.get(f"show_{key.replace(' ', '_')}")]
+    table = [[key.capitalize() for key in keys]]
+    forecasts = convert_units(config, [forecast for _, forecast in rows])
+    for (city, _), forecast in zip(rows, forecasts):
+        values = format_weather(config, forecast)
+        values["city"] = city
+        table.append([values[key] for key in keys])
+
+    widths = [max(len(row[i]) for row in table) for i in range(len(keys))]
+    return "".join("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip() + "\n" for row in table)
+
+
+# the fields available to --format, each computed from the configuration, the city and the converted forecast only if the template uses it
+FORMAT_FIELDS = {
+    "city": lambda config, city, forecast: city,
+    "weather": lambda config, city, forecast: get_weather_name(forecast[0], get_theme(config)),
+    "emoji": lambda config, city, forecast: get_theme(config).weather_emoji.get(get_weather_name(forecast[0], get_theme(config)), ""),
+    "temperature": lambda config, city, forecast: f"{forecast[3]}{config.get('temperature_unit')}",
+    "temperature_max": lambda config, city, forecast: f"{forecast[4]}{config.get('temperature_unit')}",
+    "temperature_min": lambda config, city, forecast: f"{forecast[5]}{config.get('temperature_unit')}",
+    "apparent_temperature": lambda config, city, forecast: f"{forecast[6]}{config.get('temperature_unit')}",
+    "wind_speed": lambda config, city, forecast: f"{forecast[7]} {config.get('speed_unit')}",
+    "wind_direction": lambda config, city, forecast: get_wind_direction(forecast[8]),
+    "sunrise": lambda config, city, forecast: format_time_of_day(config, forecast[1]),
+    "sunset": lambda config, city, forecast: format_time_of_day(config, forecast[2]),
+    "date": lambda config, city, forecast: get_current_time(config.get("date_pattern")),
+    "time": lambda config, city, forecast: get_current_time(config.get("time_pattern")),
+}
+
+
+def compile_template(template: str, plain: bool = False):
+    """
+    Compiles the passed --format template, e.g. '{emoji} {temperature} {wind_speed}', into a function rendering it.
+    The template is parsed once. Rendering only computes the fields it uses, see FORMAT_FIELDS, and skips the ASCII art and colors.
+
+    :param template: The template, using the syntax of str.format with the names of FORMAT_FIELDS.
+    :type template: str
+    :param plain: Whether to only allow plain placeholders like '{temperature}', without format specs or conversions. A spec like '{city:>50000000}' makes a single line as long as it asks for.
+    :type plain: bool
+    :return: A function taking the configuration, the name of the city and the forecast, and returning the rendered line.
+    :raises ValueError: If the template is invalid or uses an unknown field.
+    """
+    import string
+
+    parts = []
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        if literal:
+            parts.append(literal)
+        if field is None:
+            continue
+        if field not in FORMAT_FIELDS:
+            raise ValueError(f"Unknown field {field!r}. Available fields: {', '.join(FORMAT_FIELDS)}")
+        if plain and (spec or conversion):
+            raise ValueError(f"Only plain fields like {{{field}}} are allowed, without format specs or conversions.")
+        parts.append((field, spec or ""))
+    fields = list(dict.fromkeys(part[0] for part in parts if isinstance(part, tuple)))
+    converted = any(field not in ("city", "weather", "emoji", "wind_direction", "date", "time") for field in fields)
+
+    def render(config, city: str, forecast: tuple) -> str:
+        if converted:
+            forecast = convert_units(config, [forecast])[0]
+        values = {field: FORMAT_FIELDS[field](config, city, forecast) for field in fields}
+        return "".join(part if isinstance(part, str) else format(values[part[0]], part[1]) for part in parts) + "\n"
+
+    return render
+
+
+def render_json(config, city: str, forecast: tuple) -> str:
+    """
+    Renders the passed forecast as a single line of JSON, for --json.
+    Temperatures and the wind speed are numbers in the units of the configuration, which are included as well.
+
+    :param config: The configuration returned by load_config.
+    :type config: dict
+    :param city: The name of the city the forecast is for.
+    :type city: str
+    :param forecast: The tuple returned by get_forecast.
+    :type forecast: tuple
+    :return: The JSON object followed by a newline.
+    """
+    weather_code, sunrise, sunset, temperature, temperature_max, temperature_min, apparent_temperature, wind_speed, wind_direction, is_day = convert_units(config, [forecast])[0]
+    return json.dumps({
+        "city": city,
+        "weather": get_weather_name(weather_code, get_theme(config)),
+        "weather_code": weather_code,
+        "temperature": temperature,
+        "temperature_max": temperature_max,
+        "temperature_min": temperature_min,
+        "apparent_temperature": apparent_temperature,
+        "temperature_unit": config.get("temperature_unit"),
+        "wind_speed": wind_speed,
+        "wind_speed_unit": config.get("speed_unit"),
+        "wind_direction": wind_direction,
+        "sunrise": sunrise,
+        "sunset": sunset,
+        "is_day": is_day,
+    }, ensure_ascii=False) + "\n"
+
+
+def get_renderer(args):
+    """
+    Gets the function rendering the weather of a single location as requested by the passed CLI arguments:
+    the template passed to --format, JSON for --json or the usual output of render_weather.
+
+    :param args: The parsed CLI arguments.
+    :return: A function taking the configuration, the name of the city and the forecast, and returning the rendered text.
+    :raises ValueError: If the template passed to --format is invalid.
+    """
+    if args.json:
+        return render_json
+    if args.format is not None:
+        return compile_template(args.format)
+    return render_weather
+
+
+def read_locations_file(path: str) -> list[tuple[str, str | None]]:
+    """
+    Reads the locations from the passed file. Each line contains a city name, optionally followed by a comma and a country code.
+    Empty lines and lines starting with '#' are ignored.
+
+    :param path: The path of the file to read.
+    :type path: str
+    :return: A list containing the city name on index 0 and the country code or None on index 1 of each location.
+    """
+    locations = []
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            city_name, _, country_code = line.partition(",")
+            locations.append((city_name.strip(), country_code.strip() or None))
+    return locations
+
+
+def show_history(args, config) -> None:
+    """
+    Prints the history of the location to get the weather for over the duration passed to --history.
+
+    :param args: The parsed CLI arguments.
+    :param config: The configuration returned by load_config.
+    :type config: dict
+    :return: None
+    """
+    try:
+        duration = parse_duration(args.history)
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        exit(1)
+    try:
+        latitude, longitude, city = get_location(args, config)
+    except FetchError as error:
+        print(f"Couldn't look up the location: {error}", file=sys.stderr)
+        exit(1)
+
+    end = time.time()
+    try:
+        records = History(get_history_path(latitude, longitude)).query(end - duration, end)
+    except (OSError, ValueError):
+        records = []
+    sys.stdout.write(render_history(config, city, records, args.history, end - duration, end))
+
+
+def run_batch(config, locations: list[tuple[str, str | None]], table: bool, render=None, fields: tuple[str, ...] = WEATHER_FIELDS) -> None:
+    """
+    Prints the weather for all passed locations.
+    The cities are looked up concurrently, using at most batch_workers threads, and the weather for all of them is fetched with a single API call.
+    Cities that can't be found are reported and skipped.
+
+    :param config: The configuration returned by load_config.
+    :type config: dict
+    :param locations: The city name on index 0 and the country code or None on index 1 of each location.
+    :type locations: list
+    :param table: Print a compact table instead of one block per location.
+    :type table: bool
+    :param render: The function returned by get_renderer for --format or --json, which prints one line per location. None prints one block per location.
+    :param fields: The variables the output needs, see get_weather_fields.
+    :type fields: tuple
+    :return: None
+    """
+    import concurrent.futures
+
+    with trace.phase("location"), concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(config.get("batch_workers"), len(locations)))) as executor:
+        futures = [executor.submit(get_cached_location_by_city_name, city_name, country_code, config.get("location_ttl")) for city_name, country_code in locations]
+
+    found = []
+    for (city_name, country_code), future in zip(locations, futures):
+        try:
+            found.append(future.result())
+        except (ValueError, FetchError) as error:
+            print(f"Skipping {city_name!r}: {error}", file=sys.stderr)
+
+    if not found:
+        return
+
+    with trace.phase("forecast"):
+        forecasts = get_cached_weather_batch([(latitude, longitude) for latitude, longitude, _ in found], config.get("weather_ttl"), fields)
+
+    rows = [(city, forecast) for (_, _, city), forecast in zip(found, forecasts)]
+    with trace.phase("render"):
+        if table:
+            text = render_table(config, rows)
+        elif render is not None:
+            text = "".join(render(config, city, forecast) for city, forecast in rows)
+        else:
+            text = "\n".join(render_weather(config, city, forecast) for city, forecast in rows)
+    with trace.phase("output"):
+        print(text, end="")
+
+
+# how often Open-Meteo updates the current conditions in seconds
+UPSTREAM_UPDATE_INTERVAL = 900
 
-        sunrise_time_obj = datetime.datetime.strptime(sunrise, "%H:%M")
-        sunrise = sunrise_time_obj.strftime("%I:%M %p")
-        sunset_time_obj = datetime.datetime.strptime(sunset, "%H:%M")
-        sunset = sunset_time_obj.strftime("%I:%M %p")
-    else:
-        current_time = datetime.datetime.now().strftime("%H:%M:%S")
-        if config.get("time_format") == 24:
-            print("Invalid time format. Please use supported date format. Using default.")
 
-    wind_direction_str = get_wind_direction(wind_direction)
+def get_next_refresh(fetched_at: float, interval: float) -> float:
+    """
+    Gets when to refresh a forecast fetched at the passed time in watch mode.
+    That's interval seconds later, but not before the upstream data can have changed, because refreshing earlier would only fetch the same data again.
+
+    :param fetched_at: The time the forecast was fetched as a Unix timestamp.
+    :type fetched_at: float
+    :param interval: The minimum time in seconds between refreshes.
+    :type interval: float
+    :return: The time to refresh at as a Unix timestamp.
+    """
+    next_update = (fetched_at // UPSTREAM_UPDATE_INTERVAL + 1) * UPSTREAM_UPDATE_INTERVAL
+    return max(fetched_at + interval, next_update)
+
+
+def get_redraw(previous: list[str], lines: list[str]) -> str:
+    """
+    Gets the escape sequences and text that turn the passed previous lines on the terminal into the passed new lines.
+    The cursor is expected below the previous lines and is left below the new ones. Only lines that changed are written.
+
+    :param previous: The lines currently on the terminal, without newlines.
+    :type previous: list
+    :param lines: The lines to show, without newlines.
+    :type lines: list
+    :return: The text to write to the terminal.
+    """
+    if len(previous) != len(lines):
+        # redraw the whole block and clear what's left of a longer one
+        up = f"\x1b[{len(previous)}F" if previous else ""
+        return up + "".join(line + "\x1b[K\n" for line in lines) + "\x1b[J"
+
+    chunks = []
+    for index, (old, new) in enumerate(zip(previous, lines)):
+        if old != new:
+            distance = len(lines) - index
+            # up to the start of the line, overwrite it and back down below the block
+            chunks.append(f"\x1b[{distance}F{new}\x1b[K\x1b[{distance}E")
+    return "".join(chunks)
+
+
+def run_watch(args, config) -> None:
+    """
+    Keeps showing the weather and redraws it in place every second, so the clock keeps ticking.
+    The forecast is refreshed every args.watch seconds, but only once the upstream data can have changed, see get_next_refresh.
+    A due refresh revalidates the cached forecast, even if weather_ttl or the API would allow using it for longer.
+    If a refresh fails, the last forecast keeps being shown and the refresh is tried again after args.watch seconds.
+
+    :param args: The parsed CLI arguments.
+    :param config: The configuration returned by load_config.
+    :type config: dict
+    :return: None
+    """
+    interval = max(1.0, args.watch)
+    try:
+        render = get_renderer(args)
+    except ValueError as error:
+        print(f"Invalid format: {error}", file=sys.stderr)
+        exit(1)
+    fields = get_weather_fields(config, args)
+    try:
+        latitude, longitude, city = get_location(args, config)
+        forecast = get_forecast(config, latitude, longitude, fields)
+    except FetchError as error:
+        print(f"Couldn't fetch the weather and there is no cached data to fall back to: {error}", file=sys.stderr)
+        exit(1)
+    next_refresh = get_next_refresh(time.time(), interval)
+
+    previous: list[str] = []
+    # hide the cursor while redrawing
+    sys.stdout.write("\x1b[?25l")
+    try:
+        while True:
+            if time.time() >= next_refresh:
+                try:
+                    latitude, longitude, city = get_location(args, config)
+                    # the cached forecast may be usable for longer, but the upstream data has changed by now
+                    forecast = get_forecast(config, latitude, longitude, fields, time.time() // UPSTREAM_UPDATE_INTERVAL * UPSTREAM_UPDATE_INTERVAL)
+                    next_refresh = get_next_refresh(time.time(), interval)
+                except (FetchError, ValueError):
+                    next_refresh = time.time() + interval
+
+            lines = render(config, city, forecast).splitlines()
+            sys.stdout.write(get_redraw(previous, lines))
+            sys.stdout.flush()
+            previous = lines
+            # wake up right after the clock ticks over to the next second
+            time.sleep(1 - time.time() % 1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdout.write("\x1b[?25h")
+        sys.stdout.flush()
+
+
+class CoalescingCache:
+    """
+    An in-memory cache for the HTTP server that fetches each missing key only once, however many threads ask for it at the same time.
+    The first thread fetches it; the others wait for its result instead of fetching it as well.
+    It holds at most maxsize entries and drops the least recently used one for a new one, so clients asking for ever new keys can't make it grow without bound.
+
+    :param ttl: The time in seconds an entry is used for.
+    :param maxsize: The maximum number of entries.
+    :param errors: The exceptions raised by fetch that are cached as well, like a city that doesn't exist, so asking again doesn't fetch again.
+    :param error_ttl: The time in seconds a cached exception is raised for.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 4096, errors: tuple[type[BaseException], ...] = (), error_ttl: float = 300) -> None:
+        import threading
+        import collections
+
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.errors = errors
+        self.error_ttl = error_ttl
+        self.lock = threading.Lock()
+        # the time each entry expires at and its value or cached exception, the least recently used first
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+        self.pending: dict = {}
+
+    def get(self, key, fetch):
+        """
+        Gets the value of the passed key, calling fetch without arguments if it isn't cached or has expired.
+        If fetch raises, the exception is raised in every thread waiting for the key. It is only cached if it is one of the errors.
+        """
+        import concurrent.futures
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() < entry[0]:
+                self.entries.move_to_end(key)
+                if isinstance(entry[1], BaseException):
+                    raise entry[1]
+                return entry[1]
+            future = self.pending.get(key)
+            fetching = future is None
+            if fetching:
+                future = self.pending[key] = concurrent.futures.Future()
+        if not fetching:
+            return future.result()
+
+        try:
+            value = fetch()
+        except BaseException as error:
+            future.set_exception(error)
+            if isinstance(error, self.errors):
+                self.put(key, time.monotonic() + self.error_ttl, error)
+            raise
+        else:
+            future.set_result(value)
+            self.put(key, time.monotonic() + self.ttl, value)
+            return value
+        finally:
+            with self.lock:
+                del self.pending[key]
+
+    def put(self, key, expires_at: float, value) -> None:
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+def run_server(args, config) -> None:
+    """
+    Serves the weather over HTTP to any number of clients, so machines showing it don't each need to ask the APIs.
+    GET /?city=NAME[&country=CC] or /?lat=LAT&lon=LON returns the usual output as plain text, with '&format=json' as JSON (see render_json)
+    and with '&template=TEMPLATE' rendered from a --format template.
+    Coordinates are rounded to the 2 decimal places the forecast is fetched for, so all clients within a grid cell share one cached forecast,
+    and concurrent requests for the same cell are coalesced into a single fetch.
+    Locations and the forecasts for coordinates passed by clients are only cached in memory and not recorded in the history, so clients can't fill the disk with ever new names and cells.
+    Invalid parameters are answered with 400, cities that aren't found with 404.
+
+    :param args: The parsed CLI arguments.
+    :param config: The configuration returned by load_config.
+    :type config: dict
+    :return: None
+    """
+    import functools
+    import http.server
+    import urllib.parse
+
+    host, _, port = args.serve.rpartition(":")
+    try:
+        address = (host or "127.0.0.1", int(port))
+    except ValueError:
+        print(f"Invalid address {args.serve!r}. Use PORT or HOST:PORT.", file=sys.stderr)
+        exit(1)
+
+    # a city that isn't found stays unknown for a while, so asking for it again doesn't reach the geocoding API every time
+    locations = CoalescingCache(max(60, config.get("location_ttl")), errors=(ValueError,))
+    forecasts = CoalescingCache(max(60, config.get("weather_ttl")))
+    compile_cached_template = functools.lru_cache(maxsize=64)(functools.partial(compile_template, plain=True))
+
+    class WeatherRequestHandler(http.server.BaseHTTPRequestHandler):
+        """
+        Answers a single request for the weather, see run_server.
+        """
+        protocol_version = "HTTP/1.1"
+        # the headers and the body are sent separately, which Nagle's algorithm would delay on kept-alive connections
+        disable_nagle_algorithm = True
+
+        def do_GET(self) -> None:
+            url = urllib.parse.urlsplit(self.path)
+            if url.path not in ("/", "/weather"):
+                self.send_text(404, "Not found. Use /?city=NAME or /?lat=LAT&lon=LON.\n")
+                return
+            params = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+
+            try:
+                if params.get("format") == "json":
+                    render = render_json
+                elif "template" in params:
+                    render = compile_cached_template(params["template"])
+                else:
+                    render = functools.partial(render_weather, force_color=False)
+
+                if "city" in params:
+                    country_code = params.get("country", "").upper() or None
+                    try:
+                        # only cached in memory, as clients may ask for any name
+                        latitude, longitude, city = locations.get(
+                            (params["city"].strip().casefold(), country_code),
+                            lambda: get_cached_location_by_city_name(params["city"], country_code, 0)
+                        )
+                    except ValueError as error:
+                        self.send_text(404, f"{error}\n")
+                        return
+                    # places that exist are few enough to cache their forecasts on disk, like the CLI does
+                    fetch = lambda: get_forecast(config, latitude, longitude)
+                elif "lat" in params and "lon" in params:
+                    latitude, longitude = round(float(params["lat"]), 2), round(float(params["lon"]), 2)
+                    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+                        raise ValueError("The coordinates are out of range.")
+                    city = params.get("name") or f"{latitude:.2f}, {longitude:.2f}"
+                    fetch = lambda: get_weather(latitude, longitude)
+                else:
+                    self.send_text(400, "Pass either city or lat and lon.\n")
+                    return
+
+                forecast = forecasts.get((latitude, longitude), fetch)
+                text = render(config, city, forecast)
+            except ValueError as error:
+                self.send_text(400, f"{error}\n")
+                return
+            except FetchError as error:
+                self.send_text(502, f"Couldn't fetch the weather and there is no cached data to fall back to: {error}\n")
+                return
+            self.send_text(200, text, "application/json" if render is render_json else "text/plain")
+
+        def send_text(self, status: int, text: str, content_type: str = "text/plain") -> None:
+            body = text.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+    try:
+        server = http.server.ThreadingHTTPServer(address, WeatherRequestHandler)
+    except OSError as error:
+        print(f"Couldn't listen on {address[0]}:{address[1]}: {error}", file=sys.stderr)
+        exit(1)
+    server.daemon_threads = True
+    print(f"Serving the weather on http://{address[0]}:{address[1]}/")
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
 
-    ascii_art = get_ascii_art(weather_code, is_day)
+def run_daemon(args, config) -> None:
+    """
+    Keeps rainy running, refreshes the location and forecast every refresh_interval seconds and serves the rendered output over a Unix socket to 'rainy --client'.
+    If a refresh fails, the last data fetched keeps being served.
+
+    :param args: The parsed CLI arguments.
+    :param config: The configuration returned by load_config.
+    :type config: dict
+    :return: None
+    """
+    import signal
+    import socket
+    import threading
+    import socketserver
+
+    if not hasattr(socket, "AF_UNIX"):
+        print("The daemon isn't supported on this platform.", file=sys.stderr)
+        exit(1)
+
+    socket_path = get_socket_path()
+    if os.path.exists(socket_path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(socket_path)
+            print(f"A rainy daemon is already listening on {socket_path}.", file=sys.stderr)
+            exit(1)
+        except OSError:
+            # left behind by a daemon that didn't shut down cleanly
+            os.unlink(socket_path)
+
+    state = {}
+
+    def refresh_state() -> None:
+        latitude, longitude, city = get_location(args, config)
+        state["current"] = (city, get_forecast(config, latitude, longitude, get_weather_fields(config)))
+
+    def refresh_periodically() -> None:
+        while True:
+            time.sleep(max(1, config.get("refresh_interval")))
+            try:
+                refresh_state()
+            except (FetchError, ValueError):
+                pass
+
+    try:
+        refresh_state()
+    except FetchError as error:
+        print(f"Couldn't fetch the weather and there is no cached data to fall back to: {error}", file=sys.stderr)
+        exit(1)
+    threading.Thread(target=refresh_periodically, daemon=True).start()
+
+    class DaemonRequestHandler(socketserver.StreamRequestHandler):
+        """
+        Sends the output rendered from the daemon's latest data to a connecting client.
+        The client sends a single line first, which contains 'color' if its output may be colored.
+        """
+        timeout = 2
+
+        def handle(self) -> None:
+            try:
+                request = self.rfile.readline(64)
+            except OSError:
+                return
+            if not request:
+                # closed without a request, like the check for a running daemon does
+                return
+            city, forecast = state["current"]
+            text = render_weather(config, city, forecast, force_color=b"color" in request)
+            try:
+                self.wfile.write(text.encode("utf-8"))
+            except OSError:
+                # the client went away
+                pass
+
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    old_umask = os.umask(0o077)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(socket_path, DaemonRequestHandler)
+    finally:
+        os.umask(old_umask)
+    server.daemon_threads = True
+    # clean up the socket on 'kill' as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+
+
+def main() -> None:
+    # importing rainy itself: the modules it imports up front and its definitions
+    trace.records.append({"type": "phase", "name": "import", "start_ms": 0.0, "ms": trace.elapsed_ms()})
+
+    # parse CLI arguments
+    with trace.phase("parse_args"):
+        parser = create_parser()
+        try:
+            args = parser.parse_args()
+        except SystemExit:
+            # Help was triggered or parsing failed
+            exit()
+
+    if args.country_code and not args.city_name:
+        raise Exception("--country-code requires --city-name")
+    if args.daemon and args.locations_file:
+        raise Exception("--daemon can't be used with --locations-file")
+    if sum((args.format is not None, args.json, args.table)) > 1:
+        raise Exception("--format, --json and --table can't be combined")
+    if args.watch is not None and (args.daemon or args.locations_file or (args.city_name and len(args.city_name) > 1)):
+        raise Exception("--watch can't be used with --daemon or multiple locations")
+    if args.serve and (args.daemon or args.watch is not None):
+        raise Exception("--serve can't be used with --daemon or --watch")
+
+    trace.enabled = args.timings or bool(args.trace_file)
+    try:
+        run(args)
+    finally:
+        if args.timings:
+            sys.stdout.flush()
+            sys.stderr.write(trace.format_timings())
+        if args.trace_file:
+            try:
+                trace.write_trace_file(args.trace_file)
+            except OSError as error:
+                print(f"Couldn't write the trace file: {error}", file=sys.stderr)
+
+
+def run(args) -> None:
+    """
+    Runs rainy as requested by the passed CLI arguments.
+
+    :param args: The parsed CLI arguments.
+    :return: None
+    """
+    with trace.phase("load_config"):
+        config = load_config()
+        configure_network(config)
+
+    if args.quota:
+        sys.stdout.write(format_quota())
+        return
+    if args.history:
+        show_history(args, config)
+        return
+    if args.build_geoindex:
+        try:
+            records = build_geoindex(args.build_geoindex, get_geoindex_path())
+        except OSError as error:
+            print(f"Couldn't build the geocoding index: {error}", file=sys.stderr)
+            exit(1)
+        print(f"Indexed {records} names into {get_geoindex_path()}")
+        return
+    if args.daemon:
+        run_daemon(args, config)
+        return
+    if args.serve:
+        run_server(args, config)
+        return
+    if args.refresh:
+        refresh(args, config)
+        return
+    if args.watch is not None:
+        run_watch(args, config)
+        return
 
-    weather = get_weather_name(weather_code)
+    try:
+        render = get_renderer(args)
+    except ValueError as error:
+        print(f"Invalid format: {error}", file=sys.stderr)
+        exit(1)
+
+    if args.locations_file or (args.city_name and len(args.city_name) > 1):
+        locations = [(city_name, args.country_code) for city_name in args.city_name or []]
+        if args.locations_file:
+            try:
+                locations += read_locations_file(args.locations_file)
+            except OSError as error:
+                print(f"Couldn't read the locations file: {error}", file=sys.stderr)
+                exit(1)
+        try:
+            run_batch(config, locations, args.table, None if render is render_weather else render, get_weather_fields(config, args))
+        except FetchError as error:
+            print(f"Couldn't fetch the weather and there is no cached data to fall back to: {error}", file=sys.stderr)
+            exit(1)
+        return
 
-    output(config, ascii_art, city, weather, temperature_str, wind_speed_str, wind_direction_str, sunrise, sunset, date, current_time)
+    try:
+        with trace.phase("location"):
+            latitude, longitude, city = get_location(args, config)
+        with trace.phase("forecast"):
+            fields = get_weather_fields(config, args)
+            cached = get_cached_forecast(config, latitude, longitude, fields)
+            if cached is None:
+                forecast, age, stale = get_forecast(config, latitude, longitude, fields), 0, False
+            else:
+                forecast, age, stale = cached
+    except FetchError as error:
+        print(f"Couldn't fetch the weather and there is no cached data to fall back to: {error}", file=sys.stderr)
+        exit(1)
+
+    with trace.phase("render"):
+        text = render(config, city, forecast)
+        # a note would break the single line of --format and --json
+        if stale and render is render_weather:
+            text += f"(stale: fetched {int(age // 60)} minutes ago, refreshing in the background)\n"
+    with trace.phase("output"):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+    if stale:
+        start_background_refresh()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()